@@ -1,5 +1,7 @@
 import logging
 import os
+import time
+import signal
 import asyncio
 from aiohttp import web
 from telegram import Update
@@ -32,6 +34,8 @@ class Bot:
         self.application = None
         self.web_app = None
         self.stop_event = asyncio.Event()
+        self.ready = False
+        self.shutdown_task = None
         
     def is_authorized(self, update):
         """Check if user is authorized"""
@@ -47,7 +51,7 @@ class Bot:
             
         await update.message.reply_text(
             "Hi! I'm a Video Merger Bot.\n"
-            "Send me Google Drive video links and I'll merge them for you.\n"
+            "Send me Google Drive video links or video files and I'll merge them for you.\n"
             "Use /help to see available commands."
         )
         
@@ -75,11 +79,12 @@ Available Commands:
         await update.message.reply_text("Restarting bot...")
         
         try:
-            # Clear downloads directory
+            # Clear downloads directory, keeping files of running merges
+            active_files = self.merge_handler.get_active_files()
             for file in os.listdir(Config.DOWNLOAD_DIR):
                 file_path = os.path.join(Config.DOWNLOAD_DIR, file)
                 try:
-                    if os.path.isfile(file_path):
+                    if os.path.isfile(file_path) and file_path not in active_files:
                         os.unlink(file_path)
                 except Exception as e:
                     logger.error(f"Error deleting {file_path}: {e}")
@@ -99,11 +104,57 @@ Available Commands:
         """Health check endpoint"""
         return web.Response(text="OK", status=200)
         
+    async def readiness_check(self, request):
+        """Readiness endpoint, OK once connections are warm and polling has started"""
+        if not self.ready:
+            return web.Response(text="Starting", status=503)
+        return web.Response(text="OK", status=200)
+        
+    async def stats(self, request):
+        """Drive request counters by outcome and error class"""
+        return web.json_response(self.drive_handler.governor.get_stats())
+        
+    async def warm_up(self):
+        """Connect to MongoDB and Google Drive without blocking the event loop"""
+        started = time.monotonic()
+        try:
+            await self.db.connect()
+        except Exception as e:
+            logger.error(f"MongoDB connection error: {e}")
+        await asyncio.to_thread(self.drive_handler.connect)
+        logger.info(f"Warm-up finished in {time.monotonic() - started:.2f}s")
+        
+    def request_shutdown(self):
+        """Signal handler, starts draining once"""
+        if self.shutdown_task is None:
+            self.shutdown_task = asyncio.create_task(self.shutdown())
+        
+    async def shutdown(self):
+        """Stop taking new jobs, drain or checkpoint running ones, then stop"""
+        logger.info("Received shutdown signal, draining jobs")
+        self.ready = False
+        try:
+            # Stop long polling first, so the next instance is the only getUpdates consumer
+            await self.stop_polling()
+            await self.merge_handler.drain(Config.SHUTDOWN_GRACE_PERIOD)
+        finally:
+            logger.info(f"Drive request stats: {self.drive_handler.governor.get_stats()}")
+            self.stop_event.set()
+        
+    async def stop_polling(self):
+        if self.application and self.application.updater and self.application.updater.running:
+            try:
+                await self.application.updater.stop()
+            except Exception as e:
+                logger.error(f"Error stopping updater: {e}")
+        
     async def run_web_server(self):
         """Run web server"""
         try:
             self.web_app = web.Application()
             self.web_app.router.add_get('/', self.health_check)
+            self.web_app.router.add_get('/ready', self.readiness_check)
+            self.web_app.router.add_get('/stats', self.stats)
             
             runner = web.AppRunner(self.web_app)
             await runner.setup()
@@ -122,39 +173,61 @@ Available Commands:
             logger.error(f"Web server error: {e}")
             self.stop_event.set()
             
+    def add_handlers(self, application):
+        """Register the bot's handlers on an Application"""
+        application.add_handler(CommandHandler('start', self.start))
+        application.add_handler(CommandHandler('help', self.help))
+        application.add_handler(CommandHandler('us', self.merge_handler.settings))
+        application.add_handler(CommandHandler('merge', self.merge_handler.merge))
+        application.add_handler(CommandHandler('cancel', self.merge_handler.cancel))
+        application.add_handler(CommandHandler('restart', self.restart))
+        
+        # Drive link handler
+        application.add_handler(MessageHandler(
+            filters.TEXT & ~filters.COMMAND,
+            self.merge_handler.handle_drive_link
+        ))
+        
+        # Callback queries
+        application.add_handler(CallbackQueryHandler(self.merge_handler.button))
+        
+        # Videos sent or forwarded to the bot, before the token.pickle handler
+        application.add_handler(MessageHandler(
+            (filters.VIDEO | filters.Document.VIDEO) & ~filters.COMMAND,
+            self.merge_handler.handle_telegram_video
+        ))
+        
+        # Handle document uploads (for token.pickle)
+        application.add_handler(MessageHandler(
+            filters.Document.ALL & ~filters.COMMAND,
+            self.merge_handler.handle_token_pickle
+        ))
+        
     async def run_bot(self):
         """Run telegram bot"""
         try:
+            # Warm up connections while the application is built
+            warm_up = asyncio.create_task(self.warm_up())
+            
             # Create application
-            self.application = Application.builder().token(Config.BOT_TOKEN).build()
-            
-            # Add handlers
-            self.application.add_handler(CommandHandler('start', self.start))
-            self.application.add_handler(CommandHandler('help', self.help))
-            self.application.add_handler(CommandHandler('us', self.merge_handler.settings))
-            self.application.add_handler(CommandHandler('merge', self.merge_handler.merge))
-            self.application.add_handler(CommandHandler('cancel', self.merge_handler.cancel))
-            self.application.add_handler(CommandHandler('restart', self.restart))
-            
-            # Drive link handler
-            self.application.add_handler(MessageHandler(
-                filters.TEXT & ~filters.COMMAND,
-                self.merge_handler.handle_drive_link
-            ))
-            
-            # Callback queries
-            self.application.add_handler(CallbackQueryHandler(self.merge_handler.button))
-            
-            # Handle document uploads (for token.pickle)
-            self.application.add_handler(MessageHandler(
-                filters.Document.ALL & ~filters.COMMAND,
-                self.merge_handler.handle_token_pickle
-            ))
+            builder = Application.builder().token(Config.BOT_TOKEN)
+            if Config.TELEGRAM_API_URL:
+                # Local Bot API server, lifts the 20 MB download limit
+                builder = (
+                    builder
+                    .base_url(f"{Config.TELEGRAM_API_URL}/bot")
+                    .base_file_url(f"{Config.TELEGRAM_API_URL}/file/bot")
+                    .local_mode(Config.TELEGRAM_LOCAL_MODE)
+                )
+            self.application = builder.build()
+            self.add_handlers(self.application)
             
             create_directories()
             
             # Start bot
             await self.application.initialize()
+            await warm_up
+            self.drive_handler.credentials.start()
             logger.info("Bot started")
             
             # Delete webhook to ensure no duplicate updates
@@ -162,15 +235,23 @@ Available Commands:
             
             # Run polling with proper configuration
             await self.application.start()
+            # Pending updates are kept, messages sent during a redeploy are handled here
             await self.application.updater.start_polling(
-                drop_pending_updates=True,
                 allowed_updates=Update.ALL_TYPES,
                 stop_signals=None  # Disable automatic shutdown
             )
+            self.ready = True
+            
+            # Pick up merges checkpointed by the previous instance
+            resume_task = asyncio.create_task(
+                self.merge_handler.resume_jobs(self.application.bot)
+            )
             
             # Keep the bot running
             while not self.stop_event.is_set():
                 await asyncio.sleep(1)
+            
+            resume_task.cancel()
                     
         except Exception as e:
             logger.error(f"Bot error: {e}")
@@ -178,8 +259,12 @@ Available Commands:
             
         finally:
             # Cleanup
+            self.ready = False
+            await self.drive_handler.credentials.stop()
             if self.application:
                 try:
+                    # Application.shutdown refuses to run while the updater is running
+                    await self.stop_polling()
                     await self.application.stop()
                     await self.application.shutdown()
                 except Exception as e:
@@ -187,8 +272,13 @@ Available Commands:
             
     async def run(self):
         """Run both web server and telegram bot"""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.request_shutdown)
+        
         try:
-            # Run both services concurrently
+            # Run both services concurrently, the web server binds first so
+            # health checks pass while the bot is still warming up
             await asyncio.gather(
                 self.run_web_server(),
                 self.run_bot()
@@ -15,7 +15,50 @@ class Config:
     DRIVE_FOLDER_ID = ""  # Default drive folder id
     
     # Download
-    DOWNLOAD_DIR = "downloads"
+    DOWNLOAD_DIR = os.environ.get('DOWNLOAD_DIR', 'downloads')
     MAX_CONCURRENT_DOWNLOADS = 3
     MAX_MERGE_SIZE = 2000000000  # 2GB
-    MAX_FILES = 10 
\ No newline at end of file
+    MAX_FILES = 10
+    # Write the merged file with its index first so it plays while still downloading
+    FASTSTART_OUTPUT = True
+    
+    # Transcoding (only for parts that don't match the first part)
+    TRANSCODE_WORKERS = os.cpu_count() or 1
+    TRANSCODE_SEGMENT_MIN_DURATION = 300  # seconds, shorter inputs use one ffmpeg process
+    TRANSCODE_PRESET = 'veryfast'
+    TRANSCODE_CRF = 23
+    
+    # Shutdown
+    SHUTDOWN_GRACE_PERIOD = 40  # seconds running jobs get to finish on SIGTERM
+    CHECKPOINT_TIMEOUT = 15  # seconds to checkpoint jobs still running after that
+    RESUME_INTERVAL = 10  # seconds between checks for jobs checkpointed by another instance
+    TASK_CLAIM_LEASE = 120  # seconds before a resumed job whose instance went silent is claimed again
+    
+    # Telegram files
+    # Local Bot API server (e.g. http://localhost:8081)
+    TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '').rstrip('/')
+    # Set when that server runs with --local: only then are files over 20 MB
+    # served, as paths on the server's disk, which the bot must be able to read
+    TELEGRAM_LOCAL_MODE = os.environ.get('TELEGRAM_LOCAL_MODE', 'False').lower() == 'true'
+    TELEGRAM_CLOUD_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+    TELEGRAM_CHUNK_SIZE = 1024 * 1024
+    TELEGRAM_READ_TIMEOUT = 60  # seconds without data before a download fails
+    
+    # Drive request governor
+    DRIVE_REQUESTS_PER_SECOND = 10  # 0 disables request limiting
+    DRIVE_REQUEST_BURST = 20
+    DRIVE_BYTES_PER_SECOND = 0  # 0 disables transfer limiting
+    DRIVE_CHUNK_SIZE = 8 * 1024 * 1024  # Must be a multiple of 256KB
+    DRIVE_MAX_RETRIES = 6
+    DRIVE_BACKOFF_BASE = 1  # seconds
+    DRIVE_BACKOFF_MAX = 64  # seconds
+    
+    # Credentials
+    TOKEN_REFRESH_INTERVAL = 300  # seconds between background refresh checks
+    TOKEN_REFRESH_MARGIN = 600  # refresh tokens expiring within this many seconds
+    # Service accounts must have access to the source files and the destination folder
+    USE_SERVICE_ACCOUNTS = os.environ.get('USE_SERVICE_ACCOUNTS', 'False').lower() == 'true'
+    SERVICE_ACCOUNTS_DIR = "accounts"
+    # Drive's per account daily limits, uploads and downloads are counted separately
+    SERVICE_ACCOUNT_DAILY_UPLOAD_QUOTA = 750 * 1024 ** 3  # 750GB
+    SERVICE_ACCOUNT_DAILY_DOWNLOAD_QUOTA = 10 * 1024 ** 4  # 10TB
\ No newline at end of file
@@ -1,12 +1,42 @@
-from pymongo import MongoClient
+import time
+import asyncio
 from config import Config
 
 class MongoDB:
     def __init__(self):
-        self.client = MongoClient(Config.DATABASE_URL)
-        self.db = self.client['video_merger']
-        self.settings = self.db['settings']
-        self.tasks = self.db['tasks']
+        # The client is created on first use: resolving the mongodb+srv
+        # URL blocks, and startup should not wait for it
+        self.client = None
+    
+    def get_client(self):
+        if self.client is None:
+            from pymongo import MongoClient
+            self.client = MongoClient(Config.DATABASE_URL)
+        return self.client
+    
+    @property
+    def db(self):
+        return self.get_client()['video_merger']
+    
+    @property
+    def settings(self):
+        return self.db['settings']
+    
+    @property
+    def tasks(self):
+        return self.db['tasks']
+    
+    @property
+    def quota(self):
+        return self.db['quota']
+    
+    @property
+    def merge_cache(self):
+        return self.db['merge_cache']
+    
+    async def connect(self):
+        """Create the client and check the connection without blocking the event loop"""
+        await asyncio.to_thread(lambda: self.get_client().admin.command('ping'))
     
     async def get_user_settings(self, user_id: int):
         return self.settings.find_one({'user_id': user_id}) or {
@@ -30,4 +60,61 @@ class MongoDB:
         return list(self.tasks.find({'user_id': user_id}))
     
     async def delete_task(self, task_id):
-        return self.tasks.delete_one({'_id': task_id}) 
\ No newline at end of file
+        return self.tasks.delete_one({'_id': task_id})
+    
+    async def checkpoint_task(self, job_id: str, task_data: dict):
+        task_data['job_id'] = job_id
+        task_data.setdefault('claimed_at', None)
+        return self.tasks.replace_one({'job_id': job_id}, task_data, upsert=True)
+    
+    async def claim_task(self, instance_id: str):
+        """Atomically take one checkpointed task so only one instance resumes it.
+        
+        Tasks resumed by an instance that stopped renewing its claim (killed,
+        out of memory), and jobs that were still running when their instance
+        was stopped, can be claimed once the lease has expired.
+        """
+        now = time.time()
+        return self.tasks.find_one_and_update(
+            {'$or': [
+                {'state': 'checkpointed'},
+                {
+                    'state': {'$in': ['resumed', 'draining']},
+                    'claimed_at': {'$lt': now - Config.TASK_CLAIM_LEASE}
+                }
+            ]},
+            {'$set': {'state': 'resumed', 'instance': instance_id, 'claimed_at': now}}
+        )
+    
+    async def renew_task_claims(self, instance_id: str, job_ids: list):
+        """Extend the lease on tasks this instance is still running"""
+        return self.tasks.update_many(
+            {'job_id': {'$in': job_ids}, 'state': 'resumed', 'instance': instance_id},
+            {'$set': {'claimed_at': time.time()}}
+        )
+    
+    async def delete_job_task(self, job_id: str):
+        return self.tasks.delete_one({'job_id': job_id})
+    
+    async def get_quota_usage(self, day: str, kind: str):
+        return {
+            doc['account']: doc['bytes']
+            for doc in self.quota.find({'day': day, 'kind': kind})
+        }
+    
+    async def get_cached_merge(self, key: str):
+        return self.merge_cache.find_one({'key': key})
+    
+    async def save_cached_merge(self, key: str, result: dict):
+        return self.merge_cache.update_one(
+            {'key': key},
+            {'$set': result},
+            upsert=True
+        )
+    
+    async def add_quota_usage(self, account: str, day: str, size: int, kind: str):
+        return self.quota.update_one(
+            {'account': account, 'day': day, 'kind': kind},
+            {'$inc': {'bytes': size}},
+            upsert=True
+        ) 
\ No newline at end of file
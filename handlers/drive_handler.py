@@ -1,81 +1,57 @@
 import os
 import pickle
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
 from config import Config
 from utils.helper import get_readable_size
+from utils.governor import DriveGovernor
+from utils.credentials import CredentialManager
 import re
 import io
-from bson.binary import Binary
+
+class TransferInterrupted(Exception):
+    """Raised at a chunk boundary when a transfer's state is marked interrupted"""
+
 
 class DriveHandler:
     def __init__(self, db):
-        self.service = None
         self.folder_id = Config.DRIVE_FOLDER_ID
         self.db = db
-        self.connect()
+        self.governor = DriveGovernor()
+        self.credentials = CredentialManager(db)
     
     def connect(self):
-        """Connect to Google Drive API"""
+        """(Re)connect to Google Drive API, reloading every credential"""
         try:
-            # Try to get credentials from database first
-            creds = self.get_credentials_from_db()
-            
-            if not creds and os.path.exists('token.pickle'):
-                with open('token.pickle', 'rb') as token:
-                    creds = pickle.load(token)
-                    
-            if not creds or not creds.valid:
-                if creds and creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                else:
-                    # Don't try to create new credentials, wait for user to provide token.pickle
-                    return
-                    
-            self.service = build('drive', 'v3', credentials=creds)
+            self.credentials.load()
+            # Build the owner's service now rather than on the first request
+            self.credentials.get_service()
         except Exception as e:
             print(f"Error connecting to Drive API: {str(e)}")
     
-    def get_credentials_from_db(self):
-        """Get credentials from database"""
-        try:
-            # Get token data from database
-            settings = self.db.settings.find_one({'user_id': Config.OWNER_ID})
-            if settings and settings.get('token_pickle'):
-                # Convert Binary back to bytes
-                token_data = bytes(settings['token_pickle'])
-                return pickle.loads(token_data)
-        except Exception as e:
-            print(f"Error getting credentials from DB: {str(e)}")
-        return None
-    
-    async def update_token(self, token_pickle_data: bytes):
-        """Update token pickle in database"""
+    async def update_token(self, token_pickle_data: bytes, user_id: int = Config.OWNER_ID):
+        """Update a user's token pickle in database"""
+        from bson.binary import Binary
         try:
-            # Convert bytes to Binary for MongoDB storage
-            binary_data = Binary(token_pickle_data)
+            # Load first so an invalid file is never stored
+            creds = pickle.loads(token_pickle_data)
             
-            # Save to database
-            await self.db.update_user_settings(Config.OWNER_ID, {
-                'token_pickle': binary_data
+            # Convert bytes to Binary for MongoDB storage
+            await self.db.update_user_settings(user_id, {
+                'token_pickle': Binary(bytes(token_pickle_data))
             })
             
-            # Load new credentials
-            creds = pickle.loads(token_pickle_data)
-            self.service = build('drive', 'v3', credentials=creds)
+            key = 'owner' if user_id == Config.OWNER_ID else f"user:{user_id}"
+            self.credentials.set_credentials(key, creds)
             return True
         except Exception as e:
             print(f"Error updating token: {str(e)}")
             return False
     
-    async def update_folder_id(self, folder_id: str):
-        """Update destination folder ID"""
+    async def update_folder_id(self, folder_id: str, user_id: int = Config.OWNER_ID):
+        """Update a user's destination folder ID"""
         try:
-            self.folder_id = folder_id
-            await self.db.update_user_settings(Config.OWNER_ID, {
+            if user_id == Config.OWNER_ID:
+                self.folder_id = folder_id
+            await self.db.update_user_settings(user_id, {
                 'drive_folder': folder_id
             })
             return True
@@ -83,6 +59,13 @@ class DriveHandler:
             print(f"Error updating folder ID: {str(e)}")
             return False
     
+    async def get_folder_id(self, user_id=None):
+        """Get the destination folder ID for a user"""
+        if user_id is None:
+            return self.folder_id
+        settings = await self.db.get_user_settings(user_id)
+        return settings.get('drive_folder') or self.folder_id
+    
     def is_valid_drive_link(self, link):
         """Check if link is a valid Google Drive link"""
         patterns = [
@@ -98,16 +81,18 @@ class DriveHandler:
                 
         return None
     
-    async def get_file_info(self, link):
+    async def get_file_info(self, link, user_id=None):
         file_id = self.is_valid_drive_link(link)
         if not file_id:
             return None
             
         try:
-            file = self.service.files().get(
+            key, service = self.credentials.get_user_service(user_id)
+            file = await self.governor.execute(service.files().get(
                 fileId=file_id,
-                fields='id, name, mimeType, size'
-            ).execute()
+                fields='id, name, mimeType, size, md5Checksum',
+                supportsAllDrives=True
+            ), self.credentials.get_http(key))
             
             is_video = file['mimeType'].startswith('video/')
             
@@ -116,51 +101,163 @@ class DriveHandler:
                 'name': file['name'],
                 'size': int(file['size']),
                 'readable_size': get_readable_size(int(file['size'])),
+                'md5': file.get('md5Checksum'),
                 'is_video': is_video
             }
         except Exception as e:
             print(f"Error getting file info: {str(e)}")
             return None
     
-    async def download_file(self, file_id, path, progress_callback=None):
+    async def get_existing_file(self, file_id, user_id=None):
+        """Get metadata of a file if it still exists and is not trashed"""
+        try:
+            key, service = self.credentials.get_user_service(user_id)
+            file = await self.governor.execute(service.files().get(
+                fileId=file_id,
+                fields='id, name, parents, trashed',
+                supportsAllDrives=True
+            ), self.credentials.get_http(key))
+            return None if file.get('trashed') else file
+        except Exception as e:
+            print(f"Error getting file: {str(e)}")
+            return None
+    
+    async def copy_file(self, file_id, name, user_id=None):
+        """Server-side copy of a file into the user's destination folder"""
+        try:
+            folder_id = await self.get_folder_id(user_id)
+            key, service = self.credentials.get_user_service(user_id)
+            file = await self.governor.execute(service.files().copy(
+                fileId=file_id,
+                body={
+                    'name': name,
+                    'parents': [folder_id] if folder_id else None
+                },
+                fields='id',
+                supportsAllDrives=True
+            ), self.credentials.get_http(key))
+            return file.get('id')
+        except Exception as e:
+            print(f"Error copying file: {str(e)}")
+            return None
+    
+    async def download_file(self, file_id, path, progress_callback=None, user_id=None, size=0, state=None):
+        """Download a file, resuming from state['offset'] if the partial file is on disk.
+
+        state is updated with the offset after every chunk. Setting
+        state['interrupted'] stops the download with TransferInterrupted.
+        """
+        from googleapiclient.http import MediaIoBaseDownload
+        state = state if state is not None else {}
         try:
-            request = self.service.files().get_media(fileId=file_id)
-            fh = io.FileIO(path, 'wb')
-            downloader = MediaIoBaseDownload(fh, request)
+            offset = state.get('offset', 0)
+            key, service = await self.credentials.get_transfer_service(
+                user_id, size - offset, kind='download'
+            )
+            request = service.files().get_media(fileId=file_id, supportsAllDrives=True)
+            
+            if offset and os.path.exists(path) and os.path.getsize(path) >= offset:
+                fh = io.FileIO(path, 'r+b')
+                fh.truncate(offset)
+                fh.seek(offset)
+            else:
+                offset = 0
+                fh = io.FileIO(path, 'wb')
             
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-                if status and progress_callback:
-                    progress = status.progress() * 100
-                    progress_callback(progress)
+            with fh:
+                downloader = MediaIoBaseDownload(fh, request, chunksize=Config.DRIVE_CHUNK_SIZE)
+                # MediaIoBaseDownload has no public way to start from an offset
+                downloader._progress = offset
+                
+                done = False
+                try:
+                    while not done:
+                        if state.get('interrupted'):
+                            raise TransferInterrupted()
+                        # The downloader sends every chunk on its request's connection
+                        request.http = self.credentials.get_http(key)
+                        status, done = await self.governor.call(
+                            downloader.next_chunk,
+                            nbytes=Config.DRIVE_CHUNK_SIZE
+                        )
+                        if status:
+                            state['offset'] = status.resumable_progress
+                        if status and progress_callback:
+                            progress = status.progress() * 100
+                            progress_callback(progress)
+                finally:
+                    # Only the bytes this attempt moved, resumes don't charge them again
+                    await self.credentials.add_usage(
+                        key, 'download', downloader._progress - offset
+                    )
                     
             return True
+        except TransferInterrupted:
+            raise
         except Exception as e:
             print(f"Error downloading file: {str(e)}")
             return False
             
-    async def upload_file(self, file_path, progress_callback=None):
-        """Upload a file to Google Drive"""
+    async def upload_file(self, file_path, progress_callback=None, user_id=None, state=None):
+        """Upload a file to Google Drive, resuming the session in state['upload_uri'] if any.
+
+        Setting state['interrupted'] stops the upload with TransferInterrupted.
+        """
+        from googleapiclient.http import MediaFileUpload
+        state = state if state is not None else {}
         try:
+            folder_id = await self.get_folder_id(user_id)
             file_metadata = {
                 'name': os.path.basename(file_path),
-                'parents': [self.folder_id] if self.folder_id else None
+                'parents': [folder_id] if folder_id else None
             }
             
             media = MediaFileUpload(
                 file_path,
                 resumable=True,
-                chunksize=1024*1024
+                chunksize=Config.DRIVE_CHUNK_SIZE
             )
             
-            file = self.service.files().create(
+            # An upload session belongs to the account that opened it
+            size = os.path.getsize(file_path)
+            offset = state.get('offset', 0)
+            key, service = await self.credentials.get_transfer_service(
+                user_id, size - offset, kind='upload', key=state.get('account')
+            )
+            state['account'] = key
+            request = service.files().create(
                 body=file_metadata,
                 media_body=media,
-                fields='id'
-            ).execute()
+                fields='id',
+                supportsAllDrives=True
+            )
+            
+            if state.get('upload_uri'):
+                request.resumable_uri = state['upload_uri']
+                # Makes next_chunk ask the server how much it already has
+                request._in_error_state = True
+            
+            # Upload chunk by chunk so each one is rate limited and retried on its own
+            file = None
+            try:
+                while file is None:
+                    if state.get('interrupted'):
+                        raise TransferInterrupted()
+                    status, file = await self.governor.call(
+                        request.next_chunk,
+                        http=self.credentials.get_http(key),
+                        nbytes=Config.DRIVE_CHUNK_SIZE
+                    )
+                    state['upload_uri'] = request.resumable_uri
+                    state['offset'] = size if file else request.resumable_progress
+                    if status and progress_callback:
+                        progress_callback(status.progress() * 100)
+            finally:
+                await self.credentials.add_usage(key, 'upload', state.get('offset', 0) - offset)
             
             return file.get('id')
+        except TransferInterrupted:
+            raise
         except Exception as e:
             print(f"Error uploading file: {str(e)}")
             return None
@@ -1,18 +1,33 @@
 import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from config import Config
 from utils.video import VideoMerger
 from utils.progress import ProgressTracker
 from utils.helper import get_readable_size
+from handlers.drive_handler import TransferInterrupted
+from handlers.telegram_handler import TelegramHandler
 from telegram.ext import MessageHandler, filters
 
 class MergeHandler:
     def __init__(self, drive_handler, db):
         self.drive_handler = drive_handler
+        self.telegram_handler = TelegramHandler()
         self.db = db
         self.merger = VideoMerger()
         self.user_files = {}  # Store selected files for each user
         self.progress = ProgressTracker()
+        self.jobs = {}  # Running merge jobs by job id
+        self.status_messages = {}  # Status message of each running job
+        self.background_jobs = set()  # Tasks of jobs resumed from a checkpoint
+        self.accepting = True
+        self.interrupted = False
+        self.instance_id = uuid.uuid4().hex
+        self.download_semaphore = asyncio.Semaphore(Config.MAX_CONCURRENT_DOWNLOADS)
         
     def is_authorized(self, update):
         user_id = update.effective_user.id
@@ -30,7 +45,7 @@ class MergeHandler:
             await update.message.reply_text("Please send a valid Google Drive link.")
             return
             
-        file_info = await self.drive_handler.get_file_info(link)
+        file_info = await self.drive_handler.get_file_info(link, user_id)
         if not file_info:
             await update.message.reply_text("Unable to fetch file information.")
             return
@@ -39,6 +54,30 @@ class MergeHandler:
             await update.message.reply_text("Please send only video file links.")
             return
             
+        await self.add_file(update, file_info)
+        
+    async def handle_telegram_video(self, update, context):
+        """Add a video or video document sent (or forwarded) to the bot as a part"""
+        if not self.is_authorized(update):
+            return
+        
+        file_info = self.telegram_handler.get_file_info(update.message)
+        if not file_info or not file_info['is_video']:
+            await update.message.reply_text("Please send only video files.")
+            return
+        
+        if self.telegram_handler.is_too_large(file_info):
+            await update.message.reply_text(
+                "Files over 20 MB can only be downloaded through a local Bot API server in --local mode."
+            )
+            return
+        
+        await self.add_file(update, file_info)
+        
+    async def add_file(self, update, file_info):
+        """Add a part to the user's selection, Drive and Telegram parts alike"""
+        user_id = update.effective_user.id
+        
         # Initialize user files list if not exists
         if user_id not in self.user_files:
             self.user_files[user_id] = []
@@ -135,7 +174,7 @@ class MergeHandler:
             
         folder_id = update.message.text.strip()
         
-        if await self.drive_handler.update_folder_id(folder_id):
+        if await self.drive_handler.update_folder_id(folder_id, update.effective_user.id):
             await update.message.reply_text("Drive destination updated successfully!")
         else:
             await update.message.reply_text("Failed to update drive destination")
@@ -148,55 +187,175 @@ class MergeHandler:
             )
         )
         
+    def get_merge_key(self, files):
+        """Cache key for a merge: ordered source ids and checksums plus merge options"""
+        # Drive parts are versioned by checksum, Telegram parts by file_unique_id
+        versions = [f.get('md5') or f.get('file_unique_id') for f in files]
+        if not all(versions):
+            return None
+        
+        data = {
+            'sources': [[f['id'], version] for f, version in zip(files, versions)],
+            'params': self.merger.get_params()
+        }
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    
+    async def get_cached_result(self, cache_key, filename, user_id):
+        """Return the Drive file id of an identical earlier merge, copying it if needed"""
+        if not cache_key:
+            return None
+        
+        cached = await self.db.get_cached_merge(cache_key)
+        if not cached:
+            return None
+        
+        # The cached file may have been deleted or not be visible to this user
+        file = await self.drive_handler.get_existing_file(cached['file_id'], user_id)
+        if not file:
+            return None
+        
+        name = f"{filename}.mp4"
+        folder_id = await self.drive_handler.get_folder_id(user_id)
+        if file['name'] == name and (not folder_id or folder_id in file.get('parents', [])):
+            return file['id']
+        
+        return await self.drive_handler.copy_file(file['id'], name, user_id)
+        
     async def merge(self, update, context):
         if not self.is_authorized(update):
             return
         
         user_id = update.effective_user.id
+        if not self.accepting:
+            await update.message.reply_text("Bot is restarting, please try again in a minute.")
+            return
+        
+        if any(job['user_id'] == user_id for job in self.jobs.values()):
+            await update.message.reply_text("A merge is already running for you!")
+            return
+        
         if user_id not in self.user_files or not self.user_files[user_id]:
             await update.message.reply_text("No files selected for merging!")
             return
         
         filename = context.args[0] if context.args else f"merged_{user_id}"
+        files = self.user_files.pop(user_id)
         
         # Start the merge process
         status_message = await update.message.reply_text("Starting merge process...")
         
+        # Reuse the result of an identical earlier merge
+        cache_key = self.get_merge_key(files)
         try:
-            # Download files
-            downloaded_files = []
-            for file_info in self.user_files[user_id]:
-                file_path = os.path.join(Config.DOWNLOAD_DIR, file_info['name'])
-                
-                def progress_callback(progress):
-                    return self.progress.update_progress(
-                        progress, 100, status_message,
-                        f"Downloading: {file_info['name']}"
-                    )
-                
-                success = await self.drive_handler.download_file(
-                    file_info['id'], file_path, progress_callback
-                )
+            file_id = await self.get_cached_result(cache_key, filename, user_id)
+        except Exception as e:
+            # The cache is only an optimization, merge normally when it is unavailable
+            print(f"Error looking up merge cache: {str(e)}")
+            file_id = None
+        
+        if file_id:
+            share_link = f"https://drive.google.com/file/d/{file_id}/view"
+            await status_message.edit_text(
+                f"Merge complete!\nFile: {filename}.mp4\nLink: {share_link}"
+            )
+            return
+        
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'user_id': user_id,
+            'chat_id': update.effective_chat.id,
+            'files': files,
+            'filename': filename,
+            'cache_key': cache_key,
+            'stage': 'download',
+            'downloaded': {},  # file index -> path of finished downloads
+            'transfer': {},  # resume state of the current download or upload
+            'output_path': None
+        }
+        await self.run_job(job, status_message)
+    
+    async def run_job(self, job, status_message):
+        """Download, merge and upload a job's files.
+        
+        If the bot starts shutting down while a transfer is running, the job
+        is checkpointed to MongoDB and picked up again by resume_jobs.
+        """
+        user_id = job['user_id']
+        filename = job['filename']
+        self.jobs[job['job_id']] = job
+        self.status_messages[job['job_id']] = status_message
+        checkpointed = False
+        
+        try:
+            if job['stage'] == 'upload' and not os.path.exists(job['output_path'] or ''):
+                # The merged file did not survive the restart, start over
+                job.update(stage='download', downloaded={}, transfer={}, output_path=None)
+            
+            if job['stage'] in ('download', 'merge'):
+                # Download files
+                downloaded_files = []
+                for index, file_info in enumerate(job['files']):
+                    file_path = self.get_part_path(job, index)
+                    
+                    if (job['downloaded'].get(str(index)) == file_path
+                            and os.path.exists(file_path)
+                            and os.path.getsize(file_path) == file_info['size']):
+                        downloaded_files.append(file_path)
+                        continue
+                    
+                    if self.interrupted:
+                        raise TransferInterrupted()
+                    
+                    if job['transfer'].get('index') != index:
+                        job['transfer'] = {'index': index}
+                    
+                    def progress_callback(progress):
+                        return self.progress.update_progress(
+                            progress, 100, status_message,
+                            f"Downloading: {file_info['name']}"
+                        )
+                    
+                    async with self.download_semaphore:
+                        if file_info.get('source') == 'telegram':
+                            success = await self.telegram_handler.download_file(
+                                status_message.get_bot(), file_info['file_id'], file_path,
+                                progress_callback, size=file_info['size'],
+                                state=job['transfer']
+                            )
+                        else:
+                            success = await self.drive_handler.download_file(
+                                file_info['id'], file_path, progress_callback,
+                                user_id=user_id, size=file_info['size'],
+                                state=job['transfer']
+                            )
+                    
+                    if success:
+                        job['downloaded'][str(index)] = file_path
+                        downloaded_files.append(file_path)
+                    else:
+                        await status_message.edit_text(f"Failed to download {file_info['name']}")
+                        return
                 
-                if success:
-                    downloaded_files.append(file_path)
-                else:
-                    await status_message.edit_text(f"Failed to download {file_info['name']}")
+                # Merge videos
+                job['stage'] = 'merge'
+                output_path = await self.merger.merge_videos(downloaded_files, filename)
+                if not output_path:
+                    await status_message.edit_text("Failed to merge videos!")
                     return
-
-            # Merge videos
-            output_path = await self.merger.merge_videos(downloaded_files, filename)
-            if not output_path:
-                await status_message.edit_text("Failed to merge videos!")
-                return
+                job.update(stage='upload', output_path=output_path, transfer={})
+            
+            if self.interrupted:
+                raise TransferInterrupted()
             
             # Upload merged file
             await status_message.edit_text("Uploading merged video...")
             file_id = await self.drive_handler.upload_file(
-                output_path,
+                job['output_path'],
                 lambda p: self.progress.update_progress(
                     p, 100, status_message, "Uploading merged video"
-                )
+                ),
+                user_id=user_id,
+                state=job['transfer']
             )
             
             if file_id:
@@ -204,19 +363,151 @@ class MergeHandler:
                 await status_message.edit_text(
                     f"Merge complete!\nFile: {filename}.mp4\nLink: {share_link}"
                 )
+                if job['cache_key']:
+                    # The upload succeeded, a failed cache write must not hide the link
+                    try:
+                        await self.db.save_cached_merge(job['cache_key'], {
+                            'file_id': file_id,
+                            'name': f"{filename}.mp4",
+                            'user_id': user_id,
+                            'created_at': time.time()
+                        })
+                    except Exception as e:
+                        print(f"Error saving merge cache: {str(e)}")
             else:
                 await status_message.edit_text("Failed to upload merged video!")
+        
+        except TransferInterrupted:
+            checkpointed = await self.checkpoint(job)
+            if checkpointed:
+                await status_message.edit_text(
+                    "Bot is restarting, this merge will continue automatically."
+                )
+            else:
+                await status_message.edit_text("Bot is restarting, please start the merge again.")
                 
         except Exception as e:
             await status_message.edit_text(f"Error: {str(e)}")
             
         finally:
             # Cleanup
-            if user_id in self.user_files:
-                del self.user_files[user_id]
+            self.jobs.pop(job['job_id'], None)
+            self.status_messages.pop(job['job_id'], None)
+            if not checkpointed:
+                try:
+                    # Only this job's own checkpoint, other jobs of the user may be pending
+                    await self.db.delete_job_task(job['job_id'])
+                except Exception as e:
+                    print(f"Error deleting task: {str(e)}")
+    
+    async def checkpoint(self, job, state='checkpointed'):
+        """Save a job's progress so another instance can resume it.
+        
+        A 'draining' checkpoint is for a job that is still running: it is only
+        claimed once its lease expires, i.e. if this instance dies before the
+        job finishes (which deletes it) or checkpoints for real.
+        """
+        try:
+            job['transfer'].pop('interrupted', None)
+            task = {k: v for k, v in job.items() if k != '_id'}
+            task.update(
+                state=state,
+                instance=self.instance_id,
+                claimed_at=time.time() if state == 'draining' else None
+            )
+            await self.db.checkpoint_task(job['job_id'], task)
+            return True
+        except Exception as e:
+            print(f"Error checkpointing job: {str(e)}")
+            return False
+    
+    async def resume_jobs(self, bot):
+        """Resume jobs checkpointed by a previous instance until shutdown"""
+        while self.accepting:
+            try:
+                await self.db.renew_task_claims(self.instance_id, list(self.jobs))
+                task = await self.db.claim_task(self.instance_id)
+            except Exception as e:
+                print(f"Error claiming task: {str(e)}")
+                task = None
+            
+            if not task:
+                await asyncio.sleep(Config.RESUME_INTERVAL)
+                continue
+            
+            task.pop('_id', None)
+            task.setdefault('job_id', uuid.uuid4().hex)
+            try:
+                status_message = await bot.send_message(
+                    task['chat_id'], "Resuming merge after restart..."
+                )
+            except Exception as e:
+                print(f"Error resuming job: {str(e)}")
+                await self.db.delete_job_task(task['job_id'])
+                continue
+            
+            job = asyncio.create_task(self.run_job(task, status_message))
+            self.background_jobs.add(job)
+            job.add_done_callback(self.background_jobs.discard)
+    
+    async def drain(self, grace_period):
+        """Stop accepting jobs, let running ones finish within grace_period, checkpoint the rest"""
+        self.accepting = False
+        
+        # Only transfers observe the interrupt flag, a job in the merge stage
+        # runs until the process is killed. Record every job up front so one
+        # that doesn't finish in time is still resumed by the next instance
+        for job in list(self.jobs.values()):
+            await self.checkpoint(job, state='draining')
+        
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + grace_period
+        while self.jobs and loop.time() < deadline:
+            await asyncio.sleep(0.5)
+        
+        if not self.jobs:
+            return
+        
+        # Transfers stop at their next chunk boundary and checkpoint themselves
+        self.interrupted = True
+        for job in self.jobs.values():
+            job['transfer']['interrupted'] = True
+        
+        deadline = loop.time() + Config.CHECKPOINT_TIMEOUT
+        while self.jobs and loop.time() < deadline:
+            await asyncio.sleep(0.5)
+        
+        # Still merging, resumed from the draining checkpoint after its lease
+        for job_id in list(self.jobs):
+            try:
+                await self.status_messages[job_id].edit_text(
+                    "Bot is restarting, this merge will continue automatically."
+                )
+            except Exception as e:
+                print(f"Error updating status message: {str(e)}")
+    
+    @staticmethod
+    def get_part_path(job, index):
+        """Local path of a job's part. File names come from the sender and can
+        repeat across parts and jobs, so they are not used on disk"""
+        return os.path.join(Config.DOWNLOAD_DIR, f"{job['job_id']}_{index}.part")
+    
+    def get_active_files(self):
+        """Paths on disk that running jobs still need"""
+        paths = set()
+        for job in self.jobs.values():
+            for index in range(len(job['files'])):
+                paths.add(self.get_part_path(job, index))
+            if job.get('output_path'):
+                paths.add(job['output_path'])
+        return paths
 
     async def handle_token_pickle(self, update, context):
         """Handle uploaded token.pickle file"""
+        # The file is unpickled, accepting it from anyone would let them run code on the bot
+        if not self.is_authorized(update):
+            return
+        
         if not update.message.document:
             await update.message.reply_text("Please send the token.pickle file")
             return
@@ -229,7 +520,7 @@ class MergeHandler:
             file = await context.bot.get_file(update.message.document.file_id)
             token_data = await file.download_as_bytearray()
             
-            if await self.drive_handler.update_token(token_data):
+            if await self.drive_handler.update_token(token_data, update.effective_user.id):
                 await update.message.reply_text("Token updated successfully!")
             else:
                 await update.message.reply_text("Failed to update token")
@@ -0,0 +1,112 @@
+import os
+import asyncio
+import aiohttp
+from config import Config
+from utils.helper import get_readable_size
+from handlers.drive_handler import TransferInterrupted
+
+class TelegramHandler:
+    """Streams videos sent to the bot to disk, chunk by chunk"""
+    
+    def get_file_info(self, message):
+        """Get file info of a video or video document message"""
+        media = message.video or message.document
+        if not media:
+            return None
+        
+        mime_type = media.mime_type or ''
+        size = media.file_size or 0
+        return {
+            'source': 'telegram',
+            'id': media.file_unique_id,
+            'file_id': media.file_id,
+            # file_unique_id is the same for the same content, so it versions the part
+            'file_unique_id': media.file_unique_id,
+            'name': getattr(media, 'file_name', None) or f"{media.file_unique_id}.mp4",
+            'size': size,
+            'readable_size': get_readable_size(size),
+            'is_video': message.video is not None or mime_type.startswith('video/')
+        }
+    
+    def is_too_large(self, file_info):
+        """Only a local Bot API server running with --local serves files over 20 MB"""
+        local_mode = Config.TELEGRAM_API_URL and Config.TELEGRAM_LOCAL_MODE
+        return not local_mode and file_info['size'] > Config.TELEGRAM_CLOUD_DOWNLOAD_LIMIT
+    
+    async def download_file(self, bot, file_id, path, progress_callback=None, size=0, state=None):
+        """Download a file, resuming from state['offset'] if the partial file is on disk.
+        
+        Setting state['interrupted'] stops the download with TransferInterrupted.
+        """
+        state = state if state is not None else {}
+        try:
+            file = await bot.get_file(file_id)
+            
+            # A local Bot API server in --local mode returns a path on its own disk
+            if Config.TELEGRAM_LOCAL_MODE and os.path.isabs(file.file_path):
+                await asyncio.to_thread(
+                    self.copy_file, file.file_path, path, size, progress_callback, state
+                )
+            else:
+                await self.stream_file(file.file_path, path, size, progress_callback, state)
+            
+            return True
+        except TransferInterrupted:
+            raise
+        except aiohttp.ClientResponseError as e:
+            # The error's text has the file URL, which contains the bot token
+            print(f"Error downloading Telegram file {file_id}: HTTP {e.status}")
+            return False
+        except Exception as e:
+            print(f"Error downloading Telegram file {file_id}: {type(e).__name__}")
+            return False
+    
+    def open_output(self, path, state):
+        """Open the output file at the saved offset, or from scratch"""
+        offset = state.get('offset', 0)
+        if offset and os.path.exists(path) and os.path.getsize(path) >= offset:
+            f = open(path, 'r+b')
+            f.truncate(offset)
+            f.seek(offset)
+            return f, offset
+        
+        state['offset'] = 0
+        return open(path, 'wb'), 0
+    
+    async def stream_file(self, url, path, size, progress_callback, state):
+        f, offset = self.open_output(path, state)
+        headers = {'Range': f"bytes={offset}-"} if offset else {}
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=Config.TELEGRAM_READ_TIMEOUT)
+        
+        with f:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get(url, headers=headers) as response:
+                    response.raise_for_status()
+                    if offset and response.status != 206:
+                        # Server ignored the range, start over
+                        f.seek(0)
+                        f.truncate()
+                        offset = 0
+                    
+                    async for chunk in response.content.iter_chunked(Config.TELEGRAM_CHUNK_SIZE):
+                        if state.get('interrupted'):
+                            raise TransferInterrupted()
+                        f.write(chunk)
+                        offset += len(chunk)
+                        state['offset'] = offset
+                        if size and progress_callback:
+                            progress_callback(offset * 100 / size)
+    
+    def copy_file(self, source, path, size, progress_callback, state):
+        """Copy a file from the local Bot API server's disk, run in a thread"""
+        f, offset = self.open_output(path, state)
+        with f, open(source, 'rb') as src:
+            src.seek(offset)
+            while chunk := src.read(Config.TELEGRAM_CHUNK_SIZE):
+                if state.get('interrupted'):
+                    raise TransferInterrupted()
+                f.write(chunk)
+                offset += len(chunk)
+                state['offset'] = offset
+                if size and progress_callback:
+                    progress_callback(offset * 100 / size)
@@ -0,0 +1,111 @@
+"""Compare ffmpeg's concat + faststart with the single-pass faststart writer.
+
+Generates synthetic parts with ffmpeg's lavfi sources, then joins them with
+the concat demuxer and -movflags +faststart (which writes the file and then
+rewrites it to move the index up front) and with utils.mp4.concat_faststart.
+
+    python scripts/bench_faststart.py --parts 4 --duration 120
+
+Needs ffmpeg on PATH.
+"""
+import os
+import sys
+import time
+import struct
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('OWNER_ID', '0')
+
+
+def make_part(path, duration, size, rate):
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f"testsrc2=size={size}:rate={rate}:duration={duration}",
+        '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(rate * 2), '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-shortest', path
+    ], check=True)
+
+
+def get_layout(path):
+    """Top-level box types in file order"""
+    layout = []
+    with open(path, 'rb') as f:
+        while header := f.read(16):
+            size, box_type = struct.unpack_from('>I4s', header)
+            if size == 1:
+                size = struct.unpack_from('>Q', header, 8)[0]
+            layout.append(box_type.decode())
+            f.seek(f.tell() - len(header) + size)
+    return layout
+
+
+def ffmpeg_concat(parts, output, work_dir):
+    list_file = os.path.join(work_dir, 'parts.txt')
+    with open(list_file, 'w') as f:
+        for part in parts:
+            f.write(f"file '{part}'\n")
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', list_file,
+        '-c', 'copy', '-movflags', '+faststart', output
+    ], check=True)
+
+
+def count_frames(path):
+    result = subprocess.run(
+        ['ffmpeg', '-v', 'error', '-i', path, '-map', '0:v', '-c', 'copy', '-f', 'framemd5', '-'],
+        check=True, capture_output=True, text=True
+    )
+    return sum(1 for line in result.stdout.splitlines() if not line.startswith('#'))
+
+
+def run(args):
+    from utils.mp4 import concat_faststart
+
+    work_dir = tempfile.mkdtemp(prefix='bench-faststart-')
+    try:
+        parts = []
+        print(f"Generating {args.parts} x {args.duration}s {args.size} parts...", flush=True)
+        for index in range(args.parts):
+            part = os.path.join(work_dir, f"part_{index}.mp4")
+            make_part(part, args.duration, args.size, args.rate)
+            parts.append(part)
+        input_size = sum(os.path.getsize(part) for part in parts)
+
+        results = []
+        for name, merge in (
+            ('ffmpeg +faststart', lambda out: ffmpeg_concat(parts, out, work_dir)),
+            ('single pass', lambda out: concat_faststart(parts, out))
+        ):
+            output = os.path.join(work_dir, 'out.mp4')
+            started = time.monotonic()
+            merge(output)
+            elapsed = time.monotonic() - started
+            results.append((name, elapsed, os.path.getsize(output), count_frames(output), get_layout(output)))
+            os.remove(output)
+
+        print(f"\ninputs: {input_size / 1024 ** 2:.1f} MB")
+        print(f"{'method':>18} {'time s':>8} {'size MB':>8} {'frames':>7}  layout")
+        for name, elapsed, size, frames, layout in results:
+            print(f"{name:>18} {elapsed:>8.2f} {size / 1024 ** 2:>8.1f} {frames:>7}  {' '.join(layout)}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--parts', type=int, default=4, help='number of parts to join')
+    parser.add_argument('--duration', type=int, default=120, help='length of each part in seconds')
+    parser.add_argument('--size', default='1280x720', help='test video resolution')
+    parser.add_argument('--rate', type=int, default=30, help='test video frame rate')
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Measure how long the bot takes to answer its health and readiness endpoints.
+
+Starts `python bot.py` several times and reports, for each run, the time
+until `/` (health) and `/ready` (readiness) first return 200.
+
+    BOT_TOKEN=... OWNER_ID=... python scripts/bench_startup.py --runs 5
+
+Without a real BOT_TOKEN the bot never becomes ready, so only the health
+timings are meaningful.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def is_ok(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status == 200
+    except Exception:
+        return False
+
+
+def measure(port, timeout):
+    env = dict(os.environ, PORT=str(port))
+    env.setdefault('BOT_TOKEN', '0:benchmark')
+    env.setdefault('OWNER_ID', '0')
+
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, 'bot.py'],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+    health = ready = None
+    try:
+        while time.monotonic() - started < timeout and process.poll() is None:
+            if health is None and is_ok(f"http://127.0.0.1:{port}/"):
+                health = time.monotonic() - started
+            if health is not None and is_ok(f"http://127.0.0.1:{port}/ready"):
+                ready = time.monotonic() - started
+                break
+            time.sleep(0.02)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    return health, ready
+
+
+def summarize(name, values):
+    values = [v for v in values if v is not None]
+    if not values:
+        print(f"{name}: never reached")
+        return
+    print(
+        f"{name}: median {statistics.median(values):.3f}s, "
+        f"min {min(values):.3f}s, max {max(values):.3f}s ({len(values)} runs)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    results = []
+    for run in range(args.runs):
+        health, ready = measure(args.port, args.timeout)
+        results.append((health, ready))
+        print(f"run {run + 1}: health={health}, ready={ready}")
+
+    summarize('health', [r[0] for r in results])
+    summarize('ready', [r[1] for r in results])
+
+
+if __name__ == '__main__':
+    main()
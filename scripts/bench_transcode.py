@@ -0,0 +1,94 @@
+"""Compare single-process and chunked parallel transcoding of one long input.
+
+Generates a synthetic test video with ffmpeg's lavfi sources, then
+re-encodes it to a smaller resolution with VideoMerger.transcode, first with
+one ffmpeg process and then split into segments across a process pool.
+
+    python scripts/bench_transcode.py --duration 600 --size 1280x720
+
+Needs ffmpeg and ffprobe on PATH.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('OWNER_ID', '0')
+
+
+def make_test_video(path, duration, size, rate):
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f"testsrc2=size={size}:rate={rate}:duration={duration}",
+        '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(rate * 2), '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-shortest', path
+    ], check=True)
+
+
+def count_frames(path):
+    result = subprocess.run([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+        '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', path
+    ], check=True, capture_output=True, text=True)
+    return int(result.stdout.strip())
+
+
+async def run(args):
+    from config import Config
+    from utils.video import VideoMerger
+
+    work_dir = tempfile.mkdtemp(prefix='bench-transcode-')
+    Config.DOWNLOAD_DIR = work_dir
+    Config.TRANSCODE_SEGMENT_MIN_DURATION = args.min_segment
+    merger = VideoMerger()
+
+    source = os.path.join(work_dir, 'source.mp4')
+    print(f"Generating {args.duration}s {args.size} test video...", flush=True)
+    make_test_video(source, args.duration, args.size, args.rate)
+
+    info = merger.get_video_info(source)
+    width, height = (int(x) for x in args.target.split('x'))
+    target = dict(info, width=width, height=height)
+    source_frames = count_frames(source)
+
+    results = []
+    for workers in (1, args.workers):
+        output = os.path.join(work_dir, f"out_{workers}.mp4")
+        started = time.monotonic()
+        await merger.transcode(source, output, target, workers=workers)
+        elapsed = time.monotonic() - started
+        out_info = merger.get_video_info(output)
+        results.append((workers, elapsed, count_frames(output), out_info['duration']))
+        os.remove(output)
+
+    os.remove(source)
+    os.rmdir(work_dir)
+
+    print(f"\nsource: {source_frames} frames, {info['duration']:.2f}s")
+    print(f"{'workers':>7} {'time s':>8} {'speedup':>8} {'frames':>7} {'duration':>9}")
+    baseline = results[0][1]
+    for workers, elapsed, frames, duration in results:
+        print(f"{workers:>7} {elapsed:>8.2f} {baseline / elapsed:>7.2f}x {frames:>7} {duration:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', type=int, default=600, help='test video length in seconds')
+    parser.add_argument('--size', default='1280x720', help='test video resolution')
+    parser.add_argument('--rate', type=int, default=30, help='test video frame rate')
+    parser.add_argument('--target', default='854x480', help='resolution to transcode to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--min-segment', type=int, default=30,
+                        help='TRANSCODE_SEGMENT_MIN_DURATION for the run, in seconds')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
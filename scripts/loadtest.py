@@ -0,0 +1,523 @@
+"""Load test the bot's real update handlers with many simulated users.
+
+Runs the handlers registered by Bot.add_handlers in a python-telegram-bot
+Application that polls a local stand-in for the Bot API. Drive, MongoDB and
+ffmpeg are replaced by in-process fakes that keep the same blocking/async
+shape as the real calls. Each simulated user pastes Drive links, sends
+video files (streamed back from the stand-in's file endpoint), presses the
+Done button and runs /merge.
+
+For every concurrency level it reports update handling latency (update
+available -> first bot API call for that chat), event loop lag of the
+bot's loop and merge job throughput.
+
+    python scripts/loadtest.py --users 1,5,10,25 --parts 3 --file-size 8
+"""
+import os
+import sys
+import time
+import logging
+import uuid
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+from collections import Counter, defaultdict
+from aiohttp import web
+from telegram.ext import Application
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TOKEN = '123456:loadtest'
+OWNER_ID = 1
+USER_BASE = 1000
+BOT_USER = {'id': 42, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+
+
+def configure_environment(max_users):
+    """Config reads these at import time, so set them before importing the bot"""
+    os.environ['BOT_TOKEN'] = TOKEN
+    os.environ['OWNER_ID'] = str(OWNER_ID)
+    os.environ['AUTHORIZED_CHATS'] = ' '.join(str(USER_BASE + i) for i in range(max_users))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class FakeBotAPI:
+    """Minimal Bot API: getUpdates long polling plus the methods the handlers call"""
+
+    def __init__(self):
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.new_update = asyncio.Event()
+        self.pending = defaultdict(list)  # chat id -> times of updates not answered yet
+        self.waiters = defaultdict(list)  # chat id -> [(predicate, future)]
+        self.last_message = {}  # chat id -> last message the bot sent
+        self.callback_chats = {}  # callback query id -> chat id
+        self.files = {}  # file path -> size
+        self.latencies = []
+        self.calls = Counter()
+
+    def get_app(self):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle_method)
+        app.router.add_get('/file/bot{token}/{path:.*}', self.handle_file)
+        return app
+
+    async def handle_method(self, request):
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls[method] += 1
+
+        handler = getattr(self, f"api_{method}", None)
+        result = await handler(params) if handler else True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def handle_file(self, request):
+        size = self.files.get(request.match_info['path'], 0)
+        response = web.StreamResponse(headers={'Content-Length': str(size)})
+        await response.prepare(request)
+        chunk = b'\0' * (1024 * 1024)
+        sent = 0
+        while sent < size:
+            part = chunk[:min(len(chunk), size - sent)]
+            await response.write(part)
+            sent += len(part)
+        await response.write_eof()
+        return response
+
+    def make_message(self, chat_id, text, sender):
+        message = {
+            'message_id': self.next_message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': sender,
+            'text': text
+        }
+        self.next_message_id += 1
+        return message
+
+    def record_response(self, chat_id, text=''):
+        """Called for every bot API call aimed at a chat"""
+        if self.pending[chat_id]:
+            self.latencies.append(time.monotonic() - self.pending[chat_id].pop(0))
+
+        waiting = []
+        for predicate, future in self.waiters[chat_id]:
+            if not future.done() and predicate(text):
+                future.set_result(text)
+            elif not future.done():
+                waiting.append((predicate, future))
+        self.waiters[chat_id] = waiting
+
+    def push_update(self, chat_id, update):
+        update['update_id'] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(update)
+        self.pending[chat_id].append(time.monotonic())
+        self.new_update.set()
+
+    async def api_getMe(self, params):
+        return BOT_USER
+
+    async def api_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        self.updates = [u for u in self.updates if u['update_id'] >= offset]
+        if not self.updates and timeout:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    async def api_sendMessage(self, params):
+        chat_id = int(params['chat_id'])
+        message = self.make_message(chat_id, params.get('text', ''), BOT_USER)
+        self.last_message[chat_id] = message
+        self.record_response(chat_id, message['text'])
+        return message
+
+    async def api_editMessageText(self, params):
+        chat_id = int(params['chat_id'])
+        message = self.make_message(chat_id, params.get('text', ''), BOT_USER)
+        message['message_id'] = int(params['message_id'])
+        self.record_response(chat_id, message['text'])
+        return message
+
+    async def api_answerCallbackQuery(self, params):
+        chat_id = self.callback_chats.pop(params['callback_query_id'], None)
+        if chat_id is not None:
+            self.record_response(chat_id)
+        return True
+
+    async def api_getFile(self, params):
+        file_id = params['file_id']
+        path = f"documents/{file_id}"
+        return {
+            'file_id': file_id,
+            'file_unique_id': file_id,
+            'file_size': self.files.get(path, 0),
+            'file_path': path
+        }
+
+    def text_update(self, user_id, text):
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+        message = self.make_message(user_id, text, user)
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return {'message': message}
+
+    def video_update(self, user_id, file_id, size):
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+        message = self.make_message(user_id, None, user)
+        del message['text']
+        message['video'] = {
+            'file_id': file_id,
+            'file_unique_id': file_id,
+            'width': 1280,
+            'height': 720,
+            'duration': 60,
+            'file_size': size,
+            'mime_type': 'video/mp4'
+        }
+        self.files[f"documents/{file_id}"] = size
+        return {'message': message}
+
+    def callback_update(self, user_id, data):
+        query_id = uuid.uuid4().hex
+        self.callback_chats[query_id] = user_id
+        return {
+            'callback_query': {
+                'id': query_id,
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': self.last_message[user_id]
+            }
+        }
+
+    async def send_and_wait(self, user_id, update, predicate=lambda text: True, timeout=300):
+        """Push an update from a user and wait for a matching bot response"""
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[user_id].append((predicate, future))
+        self.push_update(user_id, update)
+        return await asyncio.wait_for(future, timeout)
+
+
+class ServerThread(threading.Thread):
+    """Runs the fake Bot API and the simulated users on their own event loop,
+    so their overhead does not show up as lag of the bot's loop"""
+
+    def __init__(self, port):
+        super().__init__(daemon=True)
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.api = None
+        self.runner = None
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start_server())
+        self.started.set()
+        self.loop.run_forever()
+
+    async def start_server(self):
+        self.api = FakeBotAPI()
+        self.runner = web.AppRunner(self.api.get_app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+
+    def submit(self, coro):
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    async def stop_server(self):
+        # Release the bot's pending long poll before closing connections
+        self.api.new_update.set()
+        await asyncio.sleep(0)
+        await self.runner.cleanup()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.stop_server(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+        self.loop.close()
+
+
+def make_fakes(args):
+    """Build Drive/MongoDB/ffmpeg stand-ins; imported lazily after configure_environment"""
+    from config import Config
+    from handlers.drive_handler import DriveHandler
+    from utils.helper import get_readable_size
+    from utils.video import VideoMerger
+
+    file_size = int(args.file_size * 1024 * 1024)
+    bandwidth = args.bandwidth * 1024 * 1024
+    chunk = b'\0' * Config.DRIVE_CHUNK_SIZE
+
+    class FakeDB:
+        async def get_user_settings(self, user_id):
+            return {'user_id': user_id, 'drive_folder': '', 'token_pickle': None}
+
+        async def get_cached_merge(self, key):
+            return None
+
+        async def save_cached_merge(self, key, result):
+            pass
+
+        async def checkpoint_task(self, job_id, task_data):
+            pass
+
+        async def claim_task(self, instance_id):
+            return None
+
+        async def renew_task_claims(self, instance_id, job_ids):
+            pass
+
+        async def delete_job_task(self, job_id):
+            pass
+
+    class FakeDriveHandler(DriveHandler):
+        """Simulates Drive latency and bandwidth, writing downloads to disk like the real one"""
+
+        async def get_file_info(self, link, user_id=None):
+            file_id = self.is_valid_drive_link(link)
+            if not file_id:
+                return None
+            await asyncio.sleep(args.latency)
+            return {
+                'id': file_id,
+                'name': f"{file_id}.mp4",
+                'size': file_size,
+                'readable_size': get_readable_size(file_size),
+                'md5': uuid.uuid4().hex,
+                'is_video': True
+            }
+
+        async def download_file(self, file_id, path, progress_callback=None, user_id=None, size=0, state=None):
+            with open(path, 'wb') as f:
+                written = 0
+                while written < file_size:
+                    part = chunk[:min(len(chunk), file_size - written)]
+                    await asyncio.sleep(args.latency + len(part) / bandwidth)
+                    f.write(part)
+                    written += len(part)
+            return True
+
+        async def upload_file(self, file_path, progress_callback=None, user_id=None, state=None):
+            size = os.path.getsize(file_path)
+            sent = 0
+            while sent < size:
+                part = min(len(chunk), size - sent)
+                await asyncio.sleep(args.latency + part / bandwidth)
+                sent += part
+            os.remove(file_path)
+            return uuid.uuid4().hex
+
+    class FakeMerger(VideoMerger):
+        """Concatenates bytes synchronously, blocking the loop the way ffmpeg.run does"""
+
+        async def merge_videos(self, video_files, output_name, progress_callback=None):
+            output_path = os.path.join(self.download_dir, f"{output_name}.mp4")
+            with open(output_path, 'wb') as out:
+                for video in video_files:
+                    with open(video, 'rb') as f:
+                        shutil.copyfileobj(f, out)
+                    os.remove(video)
+            return output_path
+
+    return FakeDB, FakeDriveHandler, FakeMerger
+
+
+async def monitor_lag(samples, stop, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+
+async def simulate_user(api, user_id, args, results):
+    try:
+        for index in range(args.parts):
+            link = f"https://drive.google.com/file/d/lt{user_id}x{index}/view"
+            await api.send_and_wait(user_id, api.text_update(user_id, link))
+
+        size = int(args.file_size * 1024 * 1024)
+        for index in range(args.telegram_parts):
+            file_id = f"tg{user_id}x{index}{uuid.uuid4().hex[:8]}"
+            await api.send_and_wait(user_id, api.video_update(user_id, file_id, size))
+
+        # Wait for the edit, not just the callback answer, so /merge can't overtake it
+        await api.send_and_wait(
+            user_id,
+            api.callback_update(user_id, 'merge_done'),
+            lambda text: text.startswith(('Please send the output', 'No files selected!'))
+        )
+
+        started = time.monotonic()
+        text = await api.send_and_wait(
+            user_id,
+            api.text_update(user_id, f"/merge lt{user_id}"),
+            lambda text: text.startswith((
+                'Merge complete', 'Failed', 'Error', 'A merge', 'No files selected for'
+            ))
+        )
+        results.append((text.startswith('Merge complete'), time.monotonic() - started))
+    except asyncio.TimeoutError:
+        results.append((False, None))
+
+
+async def simulate_users(api, users, args):
+    results = []
+    await asyncio.gather(*(
+        simulate_user(api, USER_BASE + i, args, results) for i in range(users)
+    ))
+    return results
+
+
+async def run_level(args, users, fakes):
+    from bot import Bot
+    from handlers.merge_handler import MergeHandler
+
+    FakeDB, FakeDriveHandler, FakeMerger = fakes
+    server = ServerThread(args.port)
+    server.start()
+    server.started.wait()
+
+    bot = Bot()
+    bot.db = FakeDB()
+    bot.drive_handler = FakeDriveHandler(bot.db)
+    bot.merge_handler = MergeHandler(bot.drive_handler, bot.db)
+    bot.merge_handler.merger = FakeMerger()
+
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"http://127.0.0.1:{args.port}/bot")
+        .base_file_url(f"http://127.0.0.1:{args.port}/file/bot")
+    )
+    if args.concurrent_updates:
+        builder = builder.concurrent_updates(args.concurrent_updates)
+    application = builder.build()
+    bot.add_handlers(application)
+
+    lag = []
+    stop = asyncio.Event()
+    await application.initialize()
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, timeout=5)
+    monitor = asyncio.create_task(monitor_lag(lag, stop))
+
+    started = time.monotonic()
+    results = await server.submit(simulate_users(server.api, users, args))
+    duration = time.monotonic() - started
+
+    stop.set()
+    await monitor
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    server.stop()
+
+    latencies = server.api.latencies
+    jobs = [r for r in results if r[0]]
+    return {
+        'users': users,
+        'updates': len(latencies),
+        'p50': percentile(latencies, 50) * 1000,
+        'p90': percentile(latencies, 90) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'max': max(latencies, default=0) * 1000,
+        'lag_p99': percentile(lag, 99) * 1000,
+        'lag_max': max(lag, default=0) * 1000,
+        'jobs': f"{len(jobs)}/{len(results)}",
+        'job_time': statistics.median([r[1] for r in jobs]) if jobs else 0,
+        'throughput': len(jobs) / duration if duration else 0,
+        'duration': duration
+    }
+
+
+def print_report(rows):
+    header = (
+        f"{'users':>5} {'updates':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} "
+        f"{'lag p99':>8} {'lag max':>8} {'jobs ok':>8} {'job s':>7} {'jobs/s':>7} {'time s':>7}"
+    )
+    print(header)
+    print('-' * len(header))
+    for r in rows:
+        print(
+            f"{r['users']:>5} {r['updates']:>7} {r['p50']:>8.1f} {r['p90']:>8.1f} {r['p99']:>8.1f} "
+            f"{r['max']:>8.1f} {r['lag_p99']:>8.1f} {r['lag_max']:>8.1f} {r['jobs']:>8} "
+            f"{r['job_time']:>7.2f} {r['throughput']:>7.2f} {r['duration']:>7.2f}"
+        )
+
+
+async def run(args):
+    from config import Config
+
+    # Per-request logs of the bot and its HTTP client would dominate the run
+    for name in ('httpx', 'telegram', 'bot'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    levels = [int(x) for x in args.users.split(',')]
+    download_dir = tempfile.mkdtemp(prefix='loadtest-')
+    Config.DOWNLOAD_DIR = download_dir
+    # The stand-in plays a local Bot API server in --local mode, so parts over
+    # 20 MB are allowed. Its file paths are relative, so they are still streamed
+    Config.TELEGRAM_API_URL = f"http://127.0.0.1:{args.port}"
+    Config.TELEGRAM_LOCAL_MODE = True
+    fakes = make_fakes(args)
+
+    rows = []
+    try:
+        for users in levels:
+            row = await run_level(args, users, fakes)
+            rows.append(row)
+            print(f"finished {users} users in {row['duration']:.2f}s", flush=True)
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+    print()
+    print_report(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', default='1,5,10,25', help='comma separated concurrency levels')
+    parser.add_argument('--parts', type=int, default=3, help='Drive links per user')
+    parser.add_argument('--telegram-parts', type=int, default=1, help='video files sent per user')
+    parser.add_argument('--file-size', type=float, default=8, help='size of each part in MB')
+    parser.add_argument('--bandwidth', type=float, default=200, help='simulated Drive MB/s per transfer')
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated Drive latency per call in s')
+    parser.add_argument('--concurrent-updates', type=int, default=0,
+                        help='Application.concurrent_updates, 0 processes updates sequentially like bot.py')
+    parser.add_argument('--port', type=int, default=18081)
+    args = parser.parse_args()
+
+    configure_environment(max(int(x) for x in args.users.split(',')))
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
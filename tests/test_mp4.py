@@ -0,0 +1,311 @@
+import os
+import sys
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import mp4
+from utils.mp4 import Movie, Mp4Error, concat_faststart, make_box, make_full_box
+
+MOVIE_TIMESCALE = 1000
+VIDEO_STSD = make_full_box(b'stsd', 0, 0, struct.pack('>I', 1) + make_box(b'avc1', b'\0' * 78))
+AUDIO_STSD = make_full_box(b'stsd', 0, 0, struct.pack('>I', 1) + make_box(b'mp4a', b'\0' * 28))
+
+
+def runs(values):
+    """Run-length encode a per-sample list into (count, value) entries"""
+    entries = []
+    for value in values:
+        if entries and entries[-1][1] == value:
+            entries[-1] = (entries[-1][0] + 1, value)
+        else:
+            entries.append((1, value))
+    return entries
+
+
+def video_track(sizes, chunks, ctts=None, sync=None, elst=None, delta=3000, seed=0):
+    return {
+        'handler': b'vide', 'timescale': 90000, 'stsd': VIDEO_STSD,
+        'samples': [bytes([(seed + i) % 256]) * size for i, size in enumerate(sizes)],
+        'deltas': [delta] * len(sizes), 'chunks': chunks,
+        'ctts': ctts, 'sync': sync, 'elst': elst
+    }
+
+
+def audio_track(count, chunks, size=None, seed=100):
+    sizes = [size or 10 + i for i in range(count)]
+    return {
+        'handler': b'soun', 'timescale': 48000, 'stsd': AUDIO_STSD,
+        'samples': [bytes([(seed + i) % 256]) * s for i, s in enumerate(sizes)],
+        'deltas': [1024] * count, 'chunks': chunks,
+        'constant': size is not None
+    }
+
+
+def make_trak(track_id, track, offsets):
+    duration = sum(track['deltas'])
+    payload = make_full_box(
+        b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, track_id, 0, 0) + b'\0' * 60
+    )
+    if track.get('elst'):
+        entries = b''.join(struct.pack('>Iihh', *edit) for edit in track['elst'])
+        payload += make_box(b'edts', make_full_box(
+            b'elst', 0, 0, struct.pack('>I', len(track['elst'])) + entries
+        ))
+
+    tables = [track['stsd']]
+    stts = runs(track['deltas'])
+    tables.append(make_full_box(b'stts', 0, 0, struct.pack('>I', len(stts)) + b''.join(
+        struct.pack('>II', *entry) for entry in stts
+    )))
+    if track.get('ctts'):
+        ctts = runs(track['ctts'])
+        tables.append(make_full_box(b'ctts', 0, 0, struct.pack('>I', len(ctts)) + b''.join(
+            struct.pack('>Ii', *entry) for entry in ctts
+        )))
+    if track.get('sync'):
+        tables.append(make_full_box(
+            b'stss', 0, 0, struct.pack(f">I{len(track['sync'])}I", len(track['sync']), *track['sync'])
+        ))
+
+    sizes = [len(sample) for sample in track['samples']]
+    if track.get('constant'):
+        stsz = struct.pack('>II', sizes[0], len(sizes))
+    else:
+        stsz = struct.pack(f'>II{len(sizes)}I', 0, len(sizes), *sizes)
+    tables.append(make_full_box(b'stsz', 0, 0, stsz))
+
+    stsc = []
+    for chunk, count in enumerate(track['chunks'], 1):
+        if not stsc or stsc[-1][1] != count:
+            stsc.append((chunk, count, 1))
+    tables.append(make_full_box(b'stsc', 0, 0, struct.pack('>I', len(stsc)) + b''.join(
+        struct.pack('>III', *entry) for entry in stsc
+    )))
+    tables.append(make_full_box(
+        b'stco', 0, 0, struct.pack(f'>I{len(offsets)}I', len(offsets), *offsets)
+    ))
+
+    mdhd = make_full_box(
+        b'mdhd', 0, 0, struct.pack('>IIII', 0, 0, track['timescale'], duration) + b'\x55\xc4\0\0'
+    )
+    hdlr = make_full_box(b'hdlr', 0, 0, b'\0' * 4 + track['handler'] + b'\0' * 13)
+    minf = make_box(b'minf', make_full_box(b'vmhd', 0, 1, b'\0' * 8) + make_box(b'stbl', b''.join(tables)))
+    return make_box(b'trak', payload + make_box(b'mdia', mdhd + hdlr + minf))
+
+
+def write_mp4(path, tracks):
+    """Write ftyp, mdat, moov with the tracks' chunks interleaved round robin"""
+    ftyp = make_box(b'ftyp', b'isom' + struct.pack('>I', 512) + b'isomiso2mp41')
+    chunk_data = []
+    for track in tracks:
+        chunks, index = [], 0
+        for count in track['chunks']:
+            chunks.append(b''.join(track['samples'][index:index + count]))
+            index += count
+        assert index == len(track['samples'])
+        chunk_data.append(chunks)
+
+    data = bytearray()
+    offsets = [[] for _ in tracks]
+    base = len(ftyp) + 8
+    for number in range(max(len(chunks) for chunks in chunk_data)):
+        for index, chunks in enumerate(chunk_data):
+            if number < len(chunks):
+                offsets[index].append(base + len(data))
+                data += chunks[number]
+
+    mvhd = make_full_box(b'mvhd', 0, 0, struct.pack('>IIII', 0, 0, MOVIE_TIMESCALE, 0) + b'\0' * 80)
+    traks = b''.join(
+        make_trak(index + 1, track, offsets[index]) for index, track in enumerate(tracks)
+    )
+    with open(path, 'wb') as f:
+        f.write(ftyp + make_box(b'mdat', bytes(data)) + make_box(b'moov', mvhd + traks))
+    return path
+
+
+def read_samples(path, index):
+    track = Movie(path).tracks[index]
+    samples, sample = [], 0
+    with open(path, 'rb') as f:
+        for offset, count, _ in track.chunks:
+            f.seek(offset)
+            for size in track.sizes[sample:sample + count]:
+                samples.append(f.read(size))
+            sample += count
+    return samples
+
+
+def top_level_boxes(path):
+    boxes = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    for box_type, _, _, _ in mp4.iter_boxes(data):
+        boxes.append(box_type)
+    return boxes
+
+
+def patch(path, box_type, offset, fmt, value):
+    """Overwrite a field at offset into the payload of the first box_type box"""
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    pos = data.index(box_type) + 4
+    struct.pack_into(fmt, data, pos + offset, value)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def parts(tmp_path):
+    first = write_mp4(tmp_path / 'a.mp4', [
+        video_track(
+            [30, 12, 14, 25, 11], [2, 3],
+            ctts=[0, 6000, 3000, 3000, 3000], sync=[1, 4], elst=[(166, 3000, 1, 0)]
+        ),
+        audio_track(7, [4, 3])
+    ])
+    second = write_mp4(tmp_path / 'b.mp4', [
+        video_track([20, 21, 22, 23], [2, 2], seed=50),
+        audio_track(5, [5], seed=150)
+    ])
+    return str(first), str(second)
+
+
+def test_concatenates_sample_tables(parts, tmp_path):
+    output = concat_faststart(list(parts), str(tmp_path / 'out.mp4'))
+    video, audio = Movie(output).tracks
+
+    assert video.stts == [(9, 3000)]
+    # The second part has no ctts, its samples get an offset of 0
+    assert video.ctts == [(1, 0), (1, 6000), (3, 3000), (4, 0)]
+    # The second part has no stss, all of its samples are sync samples
+    assert list(video.stss) == [1, 4, 6, 7, 8, 9]
+    assert list(video.sizes) == [30, 12, 14, 25, 11, 20, 21, 22, 23]
+    assert [count for _, count, _ in video.chunks] == [2, 3, 2, 2]
+    assert video.mdhd['duration'] == 9 * 3000
+
+    # Audio of the first part ends early, its last sample is stretched to the
+    # part's length (5 video frames at 90kHz) so the second part starts in sync
+    assert audio.stts == [(6, 1024), (1, 8000 - 6 * 1024), (5, 1024)]
+    assert [count for _, count, _ in audio.chunks] == [4, 3, 5]
+
+
+def test_copies_every_sample_once(parts, tmp_path):
+    output = concat_faststart(list(parts), str(tmp_path / 'out.mp4'))
+
+    for index in range(2):
+        expected = read_samples(parts[0], index) + read_samples(parts[1], index)
+        assert read_samples(output, index) == expected
+
+    data_size = sum(os.path.getsize(part) for part in parts)
+    assert os.path.getsize(output) < data_size
+
+
+def test_writes_moov_before_mdat(parts, tmp_path):
+    output = concat_faststart(list(parts), str(tmp_path / 'out.mp4'))
+    assert top_level_boxes(output) == [b'ftyp', b'moov', b'mdat']
+
+
+def test_extends_first_edit_list(parts, tmp_path):
+    output = concat_faststart(list(parts), str(tmp_path / 'out.mp4'))
+    video = Movie(output).tracks[0]
+    # 4 more frames of 3000/90000s, in the 1000 movie timescale
+    assert video.edits == [(166 + round(4 * 3000 * MOVIE_TIMESCALE / 90000), 3000, 1, 0)]
+
+
+def test_keeps_constant_sample_size(tmp_path):
+    first = write_mp4(tmp_path / 'a.mp4', [audio_track(6, [3, 3], size=8)])
+    second = write_mp4(tmp_path / 'b.mp4', [audio_track(4, [4], size=8, seed=7)])
+    output = concat_faststart([str(first), str(second)], str(tmp_path / 'out.mp4'))
+
+    track = Movie(output).tracks[0]
+    assert track.sample_size == 8
+    assert track.sample_count == 10
+    assert read_samples(output, 0) == read_samples(str(first), 0) + read_samples(str(second), 0)
+
+
+def test_switches_to_co64(parts, tmp_path, monkeypatch):
+    output = concat_faststart(list(parts), str(tmp_path / 'stco.mp4'))
+    with open(output, 'rb') as f:
+        data = f.read()
+    assert b'stco' in data and b'co64' not in data
+
+    # Pretend the output is past 4GB
+    monkeypatch.setattr(mp4, 'MAX_UINT32', 200)
+    output = concat_faststart(list(parts), str(tmp_path / 'co64.mp4'))
+    with open(output, 'rb') as f:
+        data = f.read()
+    moov = data[:data.index(b'mdat')]
+    assert b'co64' in moov and b'stco' not in moov
+    # mdat gets a 64-bit size
+    assert struct.unpack_from('>I', data, data.index(b'mdat') - 4)[0] == 1
+
+    for index in range(2):
+        expected = read_samples(parts[0], index) + read_samples(parts[1], index)
+        assert read_samples(output, index) == expected
+
+
+def test_rejects_different_codec_parameters(parts, tmp_path):
+    other = write_mp4(tmp_path / 'c.mp4', [
+        dict(video_track([10, 10], [2]), stsd=make_full_box(
+            b'stsd', 0, 0, struct.pack('>I', 1) + make_box(b'hvc1', b'\0' * 78)
+        )),
+        audio_track(2, [2])
+    ])
+    with pytest.raises(Mp4Error):
+        concat_faststart([parts[0], str(other)], str(tmp_path / 'out.mp4'))
+
+
+def test_rejects_different_track_layout(parts, tmp_path):
+    video_only = write_mp4(tmp_path / 'c.mp4', [video_track([10, 10], [2])])
+    with pytest.raises(Mp4Error):
+        concat_faststart([parts[0], str(video_only)], str(tmp_path / 'out.mp4'))
+
+
+def test_truncated_table(parts, tmp_path):
+    # stts entry count past the end of its box
+    patch(parts[1], b'stts', 4, '>I', 1000)
+    with pytest.raises(Mp4Error):
+        concat_faststart(list(parts), str(tmp_path / 'out.mp4'))
+
+
+def test_truncated_sample_sizes(parts, tmp_path):
+    # stsz sample count that doesn't match the chunks
+    patch(parts[1], b'stsz', 8, '>I', 1000)
+    with pytest.raises(Mp4Error):
+        concat_faststart(list(parts), str(tmp_path / 'out.mp4'))
+
+
+def test_bad_edit_list_count(parts, tmp_path):
+    patch(parts[0], b'elst', 4, '>I', 50)
+    with pytest.raises(Mp4Error):
+        concat_faststart(list(parts), str(tmp_path / 'out.mp4'))
+
+
+def test_short_64_bit_header(parts, tmp_path):
+    with open(parts[1], 'ab') as f:
+        f.write(struct.pack('>I4s', 1, b'free') + b'\0\0')
+    with pytest.raises(Mp4Error):
+        concat_faststart(list(parts), str(tmp_path / 'out.mp4'))
+
+
+def test_invalid_sample_to_chunk(parts, tmp_path):
+    # stsc first_chunk past the number of chunks
+    patch(parts[1], b'stsc', 8, '>I', 1000)
+    with pytest.raises(Mp4Error):
+        concat_faststart(list(parts), str(tmp_path / 'out.mp4'))
+
+
+def test_chunk_past_end_of_file(parts, tmp_path):
+    patch(parts[1], b'stco', 8, '>I', 10 ** 6)
+    with pytest.raises(Mp4Error):
+        concat_faststart(list(parts), str(tmp_path / 'out.mp4'))
+
+
+def test_fragmented_input(parts, tmp_path):
+    with open(parts[1], 'ab') as f:
+        f.write(make_box(b'moof', b''))
+    with pytest.raises(Mp4Error):
+        concat_faststart(list(parts), str(tmp_path / 'out.mp4'))
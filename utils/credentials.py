@@ -0,0 +1,220 @@
+import os
+import json
+import glob
+import pickle
+import asyncio
+import datetime
+from config import Config
+
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
+
+# Parsed Drive v3 discovery document, shared by every service we build
+discovery_document = None
+
+
+def get_discovery_document():
+    """Load the discovery document bundled with googleapiclient, once"""
+    global discovery_document
+    if discovery_document is None:
+        from googleapiclient.discovery_cache import get_static_doc
+        discovery_document = json.loads(get_static_doc('drive', 'v3'))
+    return discovery_document
+
+
+def build_drive_service(creds):
+    """Build a Drive service without fetching or re-parsing the discovery document"""
+    from googleapiclient.discovery import build_from_document
+    return build_from_document(get_discovery_document(), credentials=creds)
+
+
+def get_auth_request():
+    # google.auth.transport.requests pulls in requests, import it only when needed
+    from google.auth.transport.requests import Request
+    return Request()
+
+
+def utcnow():
+    # google-auth stores expiry as a naive UTC datetime
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class CredentialManager:
+    """Loads, refreshes and caches Drive credentials and the services built from them.
+
+    Credentials are cached under a key: 'owner', 'user:<id>' for per-user
+    tokens stored in MongoDB settings, and 'sa:<name>' for service accounts.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.credentials = {}
+        self.services = {}
+        self.service_accounts = []
+        self.refresh_task = None
+
+    def load(self):
+        """(Re)load owner credentials and the service account pool"""
+        self.credentials.clear()
+        self.services.clear()
+        self.service_accounts = []
+
+        creds = self.load_user_credentials(Config.OWNER_ID)
+        if not creds and os.path.exists('token.pickle'):
+            with open('token.pickle', 'rb') as token:
+                creds = pickle.load(token)
+        if creds:
+            self.set_credentials('owner', creds)
+
+        if Config.USE_SERVICE_ACCOUNTS:
+            from google.oauth2 import service_account
+            for path in sorted(glob.glob(os.path.join(Config.SERVICE_ACCOUNTS_DIR, '*.json'))):
+                try:
+                    creds = service_account.Credentials.from_service_account_file(
+                        path, scopes=DRIVE_SCOPES
+                    )
+                    key = f"sa:{os.path.basename(path)}"
+                    self.set_credentials(key, creds)
+                    self.service_accounts.append(key)
+                except Exception as e:
+                    print(f"Error loading service account {path}: {str(e)}")
+
+    def load_user_credentials(self, user_id: int):
+        """Get a user's credentials from database"""
+        try:
+            settings = self.db.settings.find_one({'user_id': user_id})
+            if settings and settings.get('token_pickle'):
+                # Convert Binary back to bytes
+                return pickle.loads(bytes(settings['token_pickle']))
+        except Exception as e:
+            print(f"Error getting credentials from DB: {str(e)}")
+        return None
+
+    def set_credentials(self, key, creds):
+        """Store credentials under key, dropping any service built from older ones"""
+        self.credentials[key] = creds
+        self.services.pop(key, None)
+
+    def get_user_key(self, user_id=None):
+        """Return the cache key of the credentials a user's requests should use"""
+        if user_id is None or user_id == Config.OWNER_ID:
+            return 'owner'
+
+        key = f"user:{user_id}"
+        if key not in self.credentials:
+            # Cache misses too, so users without a token don't hit the database every time
+            self.credentials[key] = self.load_user_credentials(user_id)
+        return key if self.credentials[key] else 'owner'
+
+    def get_service(self, key='owner'):
+        """Return the cached Drive service for key, building it on first use"""
+        if key in self.services:
+            return self.services[key]
+
+        creds = self.credentials.get(key)
+        if not creds:
+            return None
+
+        try:
+            if not creds.valid:
+                if getattr(creds, 'refresh_token', None) or key in self.service_accounts:
+                    creds.refresh(get_auth_request())
+                else:
+                    # Wait for the user to provide a new token.pickle
+                    return None
+            self.services[key] = build_drive_service(creds)
+        except Exception as e:
+            print(f"Error connecting to Drive API: {str(e)}")
+            return None
+        return self.services[key]
+
+    def get_http(self, key='owner'):
+        """Return a new authorized connection for key, for a single call made in a thread"""
+        from googleapiclient.http import build_http
+        from google_auth_httplib2 import AuthorizedHttp
+        # build_http keeps 308 (resumable upload progress) from being followed as a redirect
+        return AuthorizedHttp(self.credentials.get(key), http=build_http())
+
+    def get_user_service(self, user_id=None):
+        """Return (key, service) for metadata calls made on behalf of a user"""
+        key = self.get_user_key(user_id)
+        return key, self.get_service(key)
+
+    async def get_transfer_service(self, user_id=None, size: int = 0, kind='upload', key=None):
+        """Return (key, service) to move size bytes with, kind being 'upload' or 'download'.
+
+        Users with their own token always use it. Otherwise transfers are
+        spread over the service account pool by remaining daily quota of that
+        kind, falling back to the owner when the pool is empty or exhausted.
+        key pins a resumed transfer to the account that started it. Nothing
+        is charged here, call add_usage with the bytes actually moved.
+        """
+        if key in self.credentials:
+            return key, self.get_service(key)
+
+        key = self.get_user_key(user_id)
+        if key != 'owner' or not self.service_accounts:
+            return key, self.get_service(key)
+
+        usage = await self.db.get_quota_usage(utcnow().strftime('%Y-%m-%d'), kind)
+        remaining = {
+            sa: self.get_daily_quota(kind) - usage.get(sa, 0)
+            for sa in self.service_accounts
+        }
+        account = max(remaining, key=remaining.get)
+        if remaining[account] < size:
+            return 'owner', self.get_service('owner')
+        return account, self.get_service(account)
+
+    @staticmethod
+    def get_daily_quota(kind):
+        if kind == 'download':
+            return Config.SERVICE_ACCOUNT_DAILY_DOWNLOAD_QUOTA
+        return Config.SERVICE_ACCOUNT_DAILY_UPLOAD_QUOTA
+
+    async def add_usage(self, key, kind, size: int):
+        """Charge bytes a transfer moved to its service account's daily quota"""
+        if key not in self.service_accounts or size <= 0:
+            return
+        try:
+            await self.db.add_quota_usage(key, utcnow().strftime('%Y-%m-%d'), size, kind)
+        except Exception as e:
+            print(f"Error recording quota usage: {str(e)}")
+
+    def needs_refresh(self, creds):
+        if not creds.valid:
+            return True
+        margin = datetime.timedelta(seconds=Config.TOKEN_REFRESH_MARGIN)
+        return creds.expiry is not None and creds.expiry - utcnow() < margin
+
+    async def refresh_all(self):
+        """Refresh every cached credential that is about to expire"""
+        for key, creds in list(self.credentials.items()):
+            if not creds or not self.needs_refresh(creds):
+                continue
+            if not getattr(creds, 'refresh_token', None) and key not in self.service_accounts:
+                continue
+            try:
+                # Refreshing is a blocking HTTP call, keep it off the event loop
+                await asyncio.to_thread(creds.refresh, get_auth_request())
+            except Exception as e:
+                print(f"Error refreshing credentials for {key}: {str(e)}")
+
+    async def refresh_loop(self):
+        while True:
+            await self.refresh_all()
+            await asyncio.sleep(Config.TOKEN_REFRESH_INTERVAL)
+
+    def start(self):
+        """Start refreshing tokens in the background"""
+        if self.refresh_task is None:
+            self.refresh_task = asyncio.create_task(self.refresh_loop())
+
+    async def stop(self):
+        """Stop the background refresh task"""
+        if self.refresh_task:
+            self.refresh_task.cancel()
+            try:
+                await self.refresh_task
+            except asyncio.CancelledError:
+                pass
+            self.refresh_task = None
@@ -0,0 +1,144 @@
+import asyncio
+import random
+import socket
+import ssl
+import time
+from collections import Counter
+from config import Config
+
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+class TokenBucket:
+    """Simple token bucket shared by every coroutine that awaits it"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        # A rate of 0 means the bucket is disabled
+        if self.rate <= 0:
+            return
+
+        async with self.lock:
+            while True:
+                self._refill()
+                # Requests larger than the bucket are let through once it is full
+                needed = min(amount, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((needed - self.tokens) / self.rate)
+
+
+class DriveGovernor:
+    """Shared request/byte-rate limiter with retry and backoff for Drive calls"""
+
+    def __init__(self):
+        self.requests = TokenBucket(
+            Config.DRIVE_REQUESTS_PER_SECOND,
+            Config.DRIVE_REQUEST_BURST
+        )
+        self.bytes = TokenBucket(
+            Config.DRIVE_BYTES_PER_SECOND,
+            max(Config.DRIVE_BYTES_PER_SECOND, Config.DRIVE_CHUNK_SIZE)
+        )
+        self.counters = Counter()
+
+    @staticmethod
+    def classify_error(error):
+        """Return (error class, retryable) for an exception raised by a Drive call"""
+        # Imported lazily so the limiter itself has no hard dependency on the client
+        from googleapiclient.errors import HttpError
+
+        if isinstance(error, HttpError):
+            status = error.resp.status
+            if status == 429:
+                return 'rate_limit', True
+            if status == 403:
+                content = error.content.decode('utf-8', 'ignore') if error.content else ''
+                if any(reason in content for reason in RATE_LIMIT_REASONS):
+                    return 'rate_limit', True
+                return 'forbidden', False
+            if status >= 500:
+                return 'server_error', True
+            return 'client_error', False
+
+        # DNS lookups and TLS handshakes fail transiently too, a bad certificate doesn't
+        if isinstance(error, ssl.SSLCertVerificationError):
+            return 'other', False
+        if isinstance(error, (ConnectionError, TimeoutError, socket.gaierror, ssl.SSLError)):
+            return 'network', True
+
+        from httplib2 import ServerNotFoundError
+        if isinstance(error, ServerNotFoundError):
+            return 'network', True
+
+        return 'other', False
+
+    @staticmethod
+    def get_retry_after(error):
+        """Read the Retry-After header (in seconds) from an HttpError, if any"""
+        resp = getattr(error, 'resp', None)
+        if resp is None:
+            return None
+        try:
+            return float(resp.get('retry-after'))
+        except (TypeError, ValueError):
+            return None
+
+    def get_backoff(self, attempt: int, retry_after=None):
+        """Exponential backoff with full jitter, never shorter than Retry-After"""
+        delay = min(Config.DRIVE_BACKOFF_MAX, Config.DRIVE_BACKOFF_BASE * (2 ** attempt))
+        delay = random.uniform(0, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def call(self, func, *args, nbytes: int = 0, **kwargs):
+        """Run a blocking Drive call in a thread under the shared limits, retrying transient errors.
+
+        httplib2 connections are not thread safe, so callers pass each call
+        its own connection (see CredentialManager.get_http) rather than
+        letting it use the one shared by the service object.
+        """
+        attempt = 0
+        while True:
+            await self.requests.acquire()
+            if nbytes:
+                await self.bytes.acquire(nbytes)
+
+            try:
+                result = await asyncio.to_thread(func, *args, **kwargs)
+                self.counters['success'] += 1
+                return result
+            except Exception as e:
+                error_class, retryable = self.classify_error(e)
+                self.counters[error_class] += 1
+
+                if not retryable or attempt >= Config.DRIVE_MAX_RETRIES:
+                    self.counters['failed'] += 1
+                    raise
+
+                delay = self.get_backoff(attempt, self.get_retry_after(e))
+                self.counters['retries'] += 1
+                print(f"Drive {error_class} error, retrying in {delay:.1f}s: {str(e)}")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def execute(self, request, http, nbytes: int = 0):
+        """Execute a googleapiclient request on http under the shared limits"""
+        return await self.call(request.execute, http=http, nbytes=nbytes)
+
+    def get_stats(self):
+        """Return a copy of the per-error-class counters"""
+        return dict(self.counters)
@@ -0,0 +1,624 @@
+import os
+import sys
+import struct
+from array import array
+from itertools import accumulate
+
+MAX_UINT32 = 0xFFFFFFFF
+COPY_SIZE = 8 * 1024 * 1024
+
+# Sample table boxes rebuilt for the output, every other stbl child is dropped
+# (sdtp, sgpd, sbgp, ... describe per-sample data that is not carried over)
+STBL_TABLES = (b'stts', b'ctts', b'stss', b'stsz', b'stsc', b'stco', b'co64')
+
+
+class Mp4Error(Exception):
+    """Raised when inputs can't be joined by the single-pass writer"""
+
+
+def read_array(data, pos, count, typecode, end):
+    """Read count big-endian integers starting at data[pos], within data[:end]"""
+    values = array(typecode)
+    if pos + count * values.itemsize > end:
+        raise Mp4Error("Truncated sample table")
+    values.frombytes(data[pos:pos + count * values.itemsize])
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def pack_array(values, typecode):
+    values = array(typecode, values)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def make_box(box_type, payload):
+    if 8 + len(payload) > MAX_UINT32:
+        return struct.pack('>I4sQ', 1, box_type, 16 + len(payload)) + payload
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def make_full_box(box_type, version, flags, payload):
+    return make_box(box_type, bytes([version]) + flags.to_bytes(3, 'big') + payload)
+
+
+def iter_boxes(data, start=0, end=None):
+    """Yield (type, box start, payload start, box end) of the boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise Mp4Error(f"Invalid {box_type!r} box")
+        yield box_type, pos, pos + header, pos + size
+        pos += size
+
+
+def read_top_level(path):
+    """Return the ftyp box and the moov payload of a file"""
+    ftyp = moov = None
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        pos = 0
+        while pos + 8 <= file_size:
+            f.seek(pos)
+            header = f.read(16)
+            size, box_type = struct.unpack_from('>I4s', header)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack_from('>Q', header, 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = file_size - pos
+            if size < header_size or pos + size > file_size:
+                raise Mp4Error(f"Invalid {box_type!r} box in {path}")
+
+            if box_type == b'ftyp':
+                f.seek(pos)
+                ftyp = f.read(size)
+            elif box_type == b'moov':
+                f.seek(pos + header_size)
+                moov = f.read(size - header_size)
+            elif box_type == b'moof':
+                raise Mp4Error(f"{path} is fragmented")
+            pos += size
+
+    if ftyp is None or moov is None:
+        raise Mp4Error(f"{path} is not an MP4 file")
+    return ftyp, moov
+
+
+def parse_time_box(data, pos, with_track_id=False):
+    """Parse mvhd, tkhd or mdhd: (fields, rest) where fields hold the timing values"""
+    version = data[pos]
+    flags = int.from_bytes(data[pos + 1:pos + 4], 'big')
+    if with_track_id:
+        layout = '>QQIIQ' if version == 1 else '>IIIII'
+        created, modified, track_id, _, duration = struct.unpack_from(layout, data, pos + 4)
+        fields = {'track_id': track_id}
+    else:
+        layout = '>QQIQ' if version == 1 else '>IIII'
+        created, modified, timescale, duration = struct.unpack_from(layout, data, pos + 4)
+        fields = {'timescale': timescale}
+    fields.update(flags=flags, created=created, modified=modified, duration=duration)
+    return fields, pos + 4 + struct.calcsize(layout)
+
+
+def make_time_box(box_type, fields, rest, duration):
+    """Serialize mvhd, tkhd or mdhd with a new duration, in v1 only if needed"""
+    version = 1 if max(duration, fields['created'], fields['modified']) > MAX_UINT32 else 0
+    if 'track_id' in fields:
+        layout = '>QQIIQ' if version == 1 else '>IIIII'
+        values = (fields['created'], fields['modified'], fields['track_id'], 0, duration)
+    else:
+        layout = '>QQIQ' if version == 1 else '>IIII'
+        values = (fields['created'], fields['modified'], fields['timescale'], duration)
+    return make_full_box(box_type, version, fields['flags'], struct.pack(layout, *values) + rest)
+
+
+class Track:
+    """One trak of one input file, with its sample tables"""
+
+    def __init__(self, data, start, end, file_size):
+        self.data = data
+        self.file_size = file_size
+        self.extra = []  # trak children copied verbatim
+        self.edits = None
+        for box_type, box_start, pos, box_end in iter_boxes(data, start, end):
+            if box_type == b'tkhd':
+                self.tkhd, rest = parse_time_box(data, pos, with_track_id=True)
+                self.tkhd_rest = data[rest:box_end]
+            elif box_type == b'edts':
+                self.parse_edts(pos, box_end)
+            elif box_type == b'mdia':
+                self.parse_mdia(pos, box_end)
+            else:
+                self.extra.append(data[box_start:box_end])
+
+        if not all(hasattr(self, name) for name in ('tkhd', 'mdhd', 'hdlr', 'stsd')):
+            raise Mp4Error("Incomplete track")
+
+    def parse_edts(self, start, end):
+        for box_type, _, pos, box_end in iter_boxes(self.data, start, end):
+            if box_type != b'elst':
+                continue
+            version = self.data[pos]
+            count = struct.unpack_from('>I', self.data, pos + 4)[0]
+            layout = '>Qqhh' if version == 1 else '>Iihh'
+            size = struct.calcsize(layout)
+            if pos + 8 + count * size > box_end:
+                raise Mp4Error("Truncated edit list")
+            self.edits = [
+                struct.unpack_from(layout, self.data, pos + 8 + i * size)
+                for i in range(count)
+            ]
+
+    def parse_mdia(self, start, end):
+        self.mdia_extra = []
+        for box_type, box_start, pos, box_end in iter_boxes(self.data, start, end):
+            if box_type == b'mdhd':
+                self.mdhd, rest = parse_time_box(self.data, pos)
+                self.mdhd_rest = self.data[rest:box_end]
+            elif box_type == b'hdlr':
+                self.hdlr = self.data[box_start:box_end]
+                self.handler = self.data[pos + 8:pos + 12]
+            elif box_type == b'minf':
+                self.parse_minf(pos, box_end)
+            else:
+                self.mdia_extra.append(self.data[box_start:box_end])
+
+    def parse_minf(self, start, end):
+        self.minf_extra = []
+        for box_type, box_start, pos, box_end in iter_boxes(self.data, start, end):
+            if box_type == b'stbl':
+                self.parse_stbl(pos, box_end)
+            else:
+                self.minf_extra.append(self.data[box_start:box_end])
+
+    def parse_stbl(self, start, end):
+        data = self.data
+        boxes = {}
+        for box_type, box_start, pos, box_end in iter_boxes(data, start, end):
+            if box_type == b'stsd':
+                self.stsd = data[box_start:box_end]
+                if struct.unpack_from('>I', data, pos + 4)[0] != 1:
+                    raise Mp4Error("Multiple sample descriptions")
+            elif box_type == b'stz2':
+                raise Mp4Error("Compact sample sizes are not supported")
+            elif box_type in STBL_TABLES:
+                boxes[box_type] = pos, box_end
+
+        if b'stts' not in boxes or b'stsz' not in boxes or b'stsc' not in boxes:
+            raise Mp4Error("Incomplete sample table")
+
+        pos, box_end = boxes[b'stts']
+        count = struct.unpack_from('>I', data, pos + 4)[0]
+        values = read_array(data, pos + 8, count * 2, 'I', box_end)
+        self.stts = list(zip(values[0::2], values[1::2]))
+
+        self.ctts = None
+        if b'ctts' in boxes:
+            pos, box_end = boxes[b'ctts']
+            count = struct.unpack_from('>I', data, pos + 4)[0]
+            # Signed in v1, and v0 offsets never realistically exceed 2^31
+            values = read_array(data, pos + 8, count * 2, 'i', box_end)
+            self.ctts = list(zip(values[0::2], values[1::2]))
+
+        self.stss = None
+        if b'stss' in boxes:
+            pos, box_end = boxes[b'stss']
+            count = struct.unpack_from('>I', data, pos + 4)[0]
+            self.stss = read_array(data, pos + 8, count, 'I', box_end)
+
+        pos, box_end = boxes[b'stsc']
+        count = struct.unpack_from('>I', data, pos + 4)[0]
+        values = read_array(data, pos + 8, count * 3, 'I', box_end)
+        stsc = list(zip(values[0::3], values[1::3], values[2::3]))
+        if any(description != 1 for _, _, description in stsc):
+            raise Mp4Error("Multiple sample descriptions")
+
+        if b'co64' in boxes:
+            pos, box_end = boxes[b'co64']
+            count = struct.unpack_from('>I', data, pos + 4)[0]
+            offsets = read_array(data, pos + 8, count, 'Q', box_end)
+        elif b'stco' in boxes:
+            pos, box_end = boxes[b'stco']
+            count = struct.unpack_from('>I', data, pos + 4)[0]
+            offsets = read_array(data, pos + 8, count, 'I', box_end)
+        else:
+            raise Mp4Error("Missing chunk offsets")
+
+        firsts = [first for first, _, _ in stsc]
+        if not stsc or firsts[0] != 1 or firsts != sorted(set(firsts)) or firsts[-1] > len(offsets):
+            raise Mp4Error("Invalid sample-to-chunk table")
+
+        counts = []
+        for index, (first, per_chunk, _) in enumerate(stsc):
+            last = stsc[index + 1][0] - 1 if index + 1 < len(stsc) else len(offsets)
+            counts.extend([per_chunk] * (last - first + 1))
+
+        # Checked before a constant sample size is expanded to a table
+        pos, box_end = boxes[b'stsz']
+        sample_size, count = struct.unpack_from('>II', data, pos + 4)
+        if len(counts) != len(offsets) or sum(counts) != count:
+            raise Mp4Error("Inconsistent sample table")
+
+        if sample_size * count > self.file_size:
+            raise Mp4Error("Sample sizes exceed the file")
+
+        self.sample_size = sample_size
+        self.sample_count = count
+        if sample_size:
+            self.sizes = array('I', [sample_size]) * count
+        else:
+            self.sizes = read_array(data, pos + 12, count, 'I', box_end)
+
+        self.chunks = self.get_chunks(counts, offsets)
+
+    def get_chunks(self, counts, offsets):
+        """[(file offset, sample count, byte size)] for every chunk of the track"""
+        prefix = [0] + list(accumulate(self.sizes))
+        chunks = []
+        sample = 0
+        for offset, count in zip(offsets, counts):
+            chunks.append((offset, count, prefix[sample + count] - prefix[sample]))
+            sample += count
+            if offset + chunks[-1][2] > self.file_size:
+                raise Mp4Error("Chunk past the end of the file")
+
+        if any(a[0] > b[0] for a, b in zip(chunks, chunks[1:])):
+            raise Mp4Error("Chunks are not in file order")
+        return chunks
+
+    @property
+    def timescale(self):
+        return self.mdhd['timescale']
+
+    @property
+    def media_duration(self):
+        return sum(count * delta for count, delta in self.stts)
+
+
+class Movie:
+    """The moov of one input file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.ftyp, data = read_top_level(path)
+        self.tracks = []
+        self.extra = []
+        for box_type, box_start, pos, box_end in iter_boxes(data):
+            if box_type == b'mvhd':
+                self.mvhd, rest = parse_time_box(data, pos)
+                self.mvhd_rest = data[rest:box_end]
+            elif box_type == b'trak':
+                self.tracks.append(Track(data, pos, box_end, os.path.getsize(path)))
+            elif box_type == b'mvex':
+                raise Mp4Error(f"{path} is fragmented")
+            else:
+                self.extra.append(data[box_start:box_end])
+
+        if not hasattr(self, 'mvhd') or not self.tracks:
+            raise Mp4Error(f"{path} has no tracks")
+
+    @property
+    def duration(self):
+        """Length of the longest track in seconds"""
+        return max(track.media_duration / track.timescale for track in self.tracks)
+
+
+def read_descriptor_header(data, pos):
+    """Tag, size and payload position of an MPEG-4 descriptor in esds"""
+    tag = data[pos]
+    size = 0
+    for pos in range(pos + 1, pos + 5):
+        size = (size << 7) | (data[pos] & 0x7F)
+        if not data[pos] & 0x80:
+            break
+    return tag, size, pos + 1
+
+
+def get_codec_config(stsd):
+    """stsd with the bitrate fields blanked, they are informational and
+    differ between encodes of otherwise identical streams"""
+    config = bytearray(stsd)
+    try:
+        pos = config.find(b'btrt')
+        if pos >= 4 and config[pos - 4:pos] == b'\x00\x00\x00\x14':
+            config[pos + 4:pos + 16] = bytes(12)
+
+        pos = config.find(b'esds')
+        if pos >= 4:
+            tag, _, pos = read_descriptor_header(config, pos + 8)
+            if tag == 3:
+                flags = config[pos + 2]
+                pos += 3
+                if flags & 0x80:
+                    pos += 2
+                if flags & 0x40:
+                    pos += 1 + config[pos]
+                if flags & 0x20:
+                    pos += 2
+                tag, _, pos = read_descriptor_header(config, pos)
+                # DecoderConfigDescriptor: object type, stream type, buffer size, max and avg bitrate
+                if tag == 4:
+                    config[pos + 2:pos + 13] = bytes(11)
+    except IndexError:
+        return stsd
+    return bytes(config)
+
+
+def check_compatible(movies):
+    first = movies[0]
+    for movie in movies[1:]:
+        if len(movie.tracks) != len(first.tracks):
+            raise Mp4Error(f"{movie.path} has a different number of tracks")
+        for track, reference in zip(movie.tracks, first.tracks):
+            if track.handler != reference.handler or track.timescale != reference.timescale:
+                raise Mp4Error(f"{movie.path} has a different track layout")
+            if get_codec_config(track.stsd) != get_codec_config(reference.stsd):
+                raise Mp4Error(f"{movie.path} has different codec parameters")
+
+
+def get_part_timing(movie, track, is_last):
+    """stts of one part, with the last sample stretched so every track of a
+    part ends together and the next part starts in sync"""
+    stts = list(track.stts)
+    if is_last or not stts:
+        return stts
+
+    target = round(movie.duration * track.timescale)
+    pad = target - track.media_duration
+    if pad > 0:
+        count, delta = stts[-1]
+        stts[-1:] = [(count - 1, delta), (1, delta + pad)] if count > 1 else [(1, delta + pad)]
+    return stts
+
+
+def merge_runs(entries):
+    """Merge adjacent run-length entries with the same value"""
+    merged = []
+    for count, value in entries:
+        if not count:
+            continue
+        if merged and merged[-1][1] == value:
+            merged[-1] = (merged[-1][0] + count, value)
+        else:
+            merged.append((count, value))
+    return merged
+
+
+class OutputTrack:
+    """Concatenated sample tables of one track across all inputs"""
+
+    def __init__(self, movies, index):
+        parts = [movie.tracks[index] for movie in movies]
+        self.reference = parts[0]
+
+        stts = []
+        for number, (movie, track) in enumerate(zip(movies, parts)):
+            stts.extend(get_part_timing(movie, track, number == len(movies) - 1))
+        self.stts = merge_runs(stts)
+        self.media_duration = sum(count * delta for count, delta in self.stts)
+
+        self.ctts = None
+        if any(track.ctts for track in parts):
+            ctts = []
+            for track in parts:
+                ctts.extend(track.ctts or [(track.sample_count, 0)])
+            self.ctts = merge_runs(ctts)
+
+        self.stss = None
+        if any(track.stss is not None for track in parts):
+            self.stss = array('I')
+            base = 0
+            for track in parts:
+                if track.stss is None:
+                    self.stss.extend(range(base + 1, base + track.sample_count + 1))
+                else:
+                    self.stss.extend(n + base for n in track.stss)
+                base += track.sample_count
+
+        sample_sizes = {track.sample_size for track in parts}
+        self.sample_size = sample_sizes.pop() if len(sample_sizes) == 1 else 0
+        self.sample_count = sum(track.sample_count for track in parts)
+        self.sizes = None
+        if not self.sample_size:
+            self.sizes = array('I')
+            for track in parts:
+                self.sizes.extend(track.sizes)
+
+        # Each input chunk becomes one output chunk, offsets are filled in by the layout
+        self.chunk_counts = [count for track in parts for _, count, _ in track.chunks]
+        self.offsets = [0] * len(self.chunk_counts)
+
+    def get_edits(self, movie_timescale):
+        """The first part's edit list, its last edit extended over the other parts.
+
+        Only the first part's start offset (e.g. AAC priming) is applied,
+        the other parts play from their first sample.
+        """
+        edits = list(self.reference.edits or [])
+        if not edits:
+            return []
+
+        added = self.media_duration - self.reference.media_duration
+        duration, media_time, rate, fraction = edits[-1]
+        duration += round(added * movie_timescale / self.reference.timescale)
+        edits[-1] = (duration, media_time, rate, fraction)
+        return edits
+
+    def get_duration(self, movie_timescale):
+        """Track duration in the movie timescale, after the edit list"""
+        edits = self.get_edits(movie_timescale)
+        if edits:
+            return sum(duration for duration, _, _, _ in edits)
+        return round(self.media_duration * movie_timescale / self.reference.timescale)
+
+    def make_edts(self, movie_timescale):
+        edits = self.get_edits(movie_timescale)
+        if not edits:
+            return b''
+
+        version = 1 if any(d > MAX_UINT32 or abs(t) > 0x7FFFFFFF for d, t, _, _ in edits) else 0
+        layout = '>Qqhh' if version == 1 else '>Iihh'
+        payload = struct.pack('>I', len(edits)) + b''.join(
+            struct.pack(layout, *edit) for edit in edits
+        )
+        return make_box(b'edts', make_full_box(b'elst', version, 0, payload))
+
+    def make_stbl(self, co64):
+        tables = [self.reference.stsd]
+
+        values = [v for entry in self.stts for v in entry]
+        tables.append(make_full_box(
+            b'stts', 0, 0, struct.pack('>I', len(self.stts)) + pack_array(values, 'I')
+        ))
+
+        if self.ctts:
+            values = [v for entry in self.ctts for v in entry]
+            version = 1 if any(v < 0 for _, v in self.ctts) else 0
+            tables.append(make_full_box(
+                b'ctts', version, 0, struct.pack('>I', len(self.ctts)) + pack_array(values, 'i')
+            ))
+
+        if self.stss is not None:
+            tables.append(make_full_box(
+                b'stss', 0, 0, struct.pack('>I', len(self.stss)) + pack_array(self.stss, 'I')
+            ))
+
+        payload = struct.pack('>II', self.sample_size, self.sample_count)
+        if not self.sample_size:
+            payload += pack_array(self.sizes, 'I')
+        tables.append(make_full_box(b'stsz', 0, 0, payload))
+
+        runs = []
+        for chunk, count in enumerate(self.chunk_counts, 1):
+            if not runs or runs[-1][1] != count:
+                runs.append((chunk, count, 1))
+        values = [v for entry in runs for v in entry]
+        tables.append(make_full_box(
+            b'stsc', 0, 0, struct.pack('>I', len(runs)) + pack_array(values, 'I')
+        ))
+
+        offsets = pack_array(self.offsets, 'Q' if co64 else 'I')
+        tables.append(make_full_box(
+            b'co64' if co64 else b'stco', 0, 0, struct.pack('>I', len(self.offsets)) + offsets
+        ))
+        return make_box(b'stbl', b''.join(tables))
+
+    def make_trak(self, movie_timescale, co64):
+        track = self.reference
+        minf = make_box(b'minf', b''.join(track.minf_extra) + self.make_stbl(co64))
+        mdia = make_box(b'mdia', (
+            make_time_box(b'mdhd', track.mdhd, track.mdhd_rest, self.media_duration)
+            + track.hdlr
+            + b''.join(track.mdia_extra)
+            + minf
+        ))
+        tkhd = make_time_box(
+            b'tkhd', track.tkhd, track.tkhd_rest, self.get_duration(movie_timescale)
+        )
+        return make_box(b'trak', tkhd + self.make_edts(movie_timescale) + mdia + b''.join(track.extra))
+
+
+def plan_layout(movies, tracks):
+    """Order every input chunk for a sequential copy and assign output offsets.
+
+    Returns [(path, [(input offset, size)])] with adjacent chunks coalesced,
+    and fills each output track's offsets relative to the start of mdat data.
+    """
+    plan = []
+    position = 0
+    chunk_base = [0] * len(tracks)
+    for movie in movies:
+        chunks = []
+        for index, track in enumerate(movie.tracks):
+            for number, (offset, _, size) in enumerate(track.chunks):
+                chunks.append((offset, size, index, chunk_base[index] + number))
+            chunk_base[index] += len(track.chunks)
+        chunks.sort()
+
+        ranges = []
+        for offset, size, index, number in chunks:
+            tracks[index].offsets[number] = position
+            position += size
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + size)
+            else:
+                ranges.append((offset, size))
+        plan.append((movie.path, ranges))
+    return plan, position
+
+
+def make_moov(first, tracks, base, co64):
+    relative = [track.offsets for track in tracks]
+    for track in tracks:
+        track.offsets = [base + offset for offset in track.offsets]
+    try:
+        timescale = first.mvhd['timescale']
+        traks = [track.make_trak(timescale, co64) for track in tracks]
+        duration = max(track.get_duration(timescale) for track in tracks)
+        mvhd = make_time_box(b'mvhd', first.mvhd, first.mvhd_rest, duration)
+        return make_box(b'moov', mvhd + b''.join(traks) + b''.join(first.extra))
+    finally:
+        for track, offsets in zip(tracks, relative):
+            track.offsets = offsets
+
+
+def concat_faststart(input_paths, output_path):
+    """Join MP4 files with identical codec parameters into one faststart MP4.
+
+    The merged sample tables are computed from the inputs' indexes first, so
+    the moov can be written before mdat and every sample is copied exactly
+    once, in a single sequential pass. Raises Mp4Error for inputs this
+    can't handle (fragmented files, differing tracks or codec parameters).
+    """
+    try:
+        movies = [Movie(path) for path in input_paths]
+        check_compatible(movies)
+
+        first = movies[0]
+        tracks = [OutputTrack(movies, index) for index in range(len(first.tracks))]
+        plan, data_size = plan_layout(movies, tracks)
+
+        mdat_header = 8 if data_size + 8 <= MAX_UINT32 else 16
+        co64 = False
+        moov = make_moov(first, tracks, 0, co64)
+        base = len(first.ftyp) + len(moov) + mdat_header
+        if base + data_size > MAX_UINT32:
+            co64 = True
+            base = len(first.ftyp) + len(make_moov(first, tracks, 0, co64)) + mdat_header
+        moov = make_moov(first, tracks, base, co64)
+    except (struct.error, IndexError, ValueError, OverflowError, ZeroDivisionError) as e:
+        # Malformed boxes the parser doesn't check for, ffmpeg may still read them
+        raise Mp4Error(f"Unsupported MP4 structure: {str(e)}")
+
+    with open(output_path, 'wb') as out:
+        out.write(first.ftyp)
+        out.write(moov)
+        if mdat_header == 8:
+            out.write(struct.pack('>I4s', 8 + data_size, b'mdat'))
+        else:
+            out.write(struct.pack('>I4sQ', 1, b'mdat', 16 + data_size))
+
+        for path, ranges in plan:
+            with open(path, 'rb') as f:
+                for offset, size in ranges:
+                    f.seek(offset)
+                    while size:
+                        data = f.read(min(COPY_SIZE, size))
+                        if not data:
+                            raise Mp4Error(f"{path} is truncated")
+                        out.write(data)
+                        size -= len(data)
+
+    return output_path
@@ -1,52 +1,298 @@
 import os
-import ffmpeg
+import shutil
+import asyncio
+import tempfile
+import subprocess
 from config import Config
+from utils.mp4 import Mp4Error, concat_faststart
+
+# ffmpeg encoders used to re-encode a part into another part's codec
+VIDEO_ENCODERS = {
+    'h264': 'libx264',
+    'hevc': 'libx265',
+    'mpeg4': 'mpeg4',
+    'vp9': 'libvpx-vp9'
+}
+AUDIO_ENCODERS = {
+    'aac': 'aac',
+    'mp3': 'libmp3lame',
+    'opus': 'libopus',
+    'ac3': 'ac3'
+}
+
+# Stream properties that must be identical for a lossless concat. Frame rate
+# is not one of them: the concat demuxer copies timestamps, and phone clips
+# are variable frame rate, so their average rates almost never match
+MATCH_KEYS = ('codec', 'width', 'height', 'pix_fmt', 'audio_codec', 'sample_rate', 'channels')
+
+
+async def run_ffmpeg(args):
+    """Run one compiled ffmpeg command line, killing it if the caller is cancelled"""
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args, stderr=stderr)
+
 
 class VideoMerger:
     def __init__(self):
         self.download_dir = Config.DOWNLOAD_DIR
-        
+    
+    def get_params(self):
+        """Output options that affect the merged file's content"""
+        return {
+            'format': 'mp4',
+            'codec': 'copy',
+            'faststart': Config.FASTSTART_OUTPUT,
+            'transcode_preset': Config.TRANSCODE_PRESET,
+            'transcode_crf': Config.TRANSCODE_CRF
+        }
+    
     async def merge_videos(self, video_files, output_name, progress_callback=None):
+        import ffmpeg
         try:
-            # Create a temporary file list
-            list_file = os.path.join(self.download_dir, "files.txt")
-            with open(list_file, "w") as f:
-                for video in video_files:
-                    f.write(f"file '{video}'\n")
-            
+            # Concat copy needs identical streams, re-encode parts that differ
+            video_files = await self.match_parts(video_files)
             output_path = os.path.join(self.download_dir, f"{output_name}.mp4")
             
-            # Use ffmpeg-python for merging
-            stream = ffmpeg.input(list_file, format='concat', safe=0)
-            stream = ffmpeg.output(stream, output_path, c='copy')
+            merged = False
+            if Config.FASTSTART_OUTPUT:
+                # Index first and every sample written once, no second pass to move the moov
+                try:
+                    await asyncio.to_thread(concat_faststart, video_files, output_path)
+                    merged = True
+                except Mp4Error as e:
+                    print(f"Falling back to ffmpeg concat: {str(e)}")
             
-            # Run the ffmpeg command
-            ffmpeg.run(stream, overwrite_output=True)
+            if not merged:
+                # Create a temporary file list, one per merge since merges run concurrently
+                fd, list_file = tempfile.mkstemp(suffix='.txt', dir=self.download_dir)
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        for video in video_files:
+                            # Relative entries would be resolved against the list's directory
+                            f.write(f"file '{os.path.abspath(video)}'\n")
+                    
+                    output_args = {'c': 'copy'}
+                    if Config.FASTSTART_OUTPUT:
+                        output_args['movflags'] = '+faststart'
+                    
+                    # Use ffmpeg-python for merging
+                    stream = ffmpeg.input(list_file, format='concat', safe=0)
+                    stream = ffmpeg.output(stream, output_path, **output_args)
+                    
+                    # Run the ffmpeg command without blocking the event loop
+                    await run_ffmpeg(ffmpeg.compile(stream, overwrite_output=True))
+                finally:
+                    os.remove(list_file)
             
             # Clean up
-            os.remove(list_file)
             for video in video_files:
                 if os.path.exists(video):
                     os.remove(video)
-                    
-            return output_path
             
+            return output_path
+        
         except Exception as e:
             print(f"Error merging videos: {str(e)}")
             return None
     
+    async def match_parts(self, video_files):
+        """Re-encode every part whose streams differ from the first part's"""
+        # ffprobe blocks, probe the parts in threads
+        infos = await asyncio.gather(*(
+            asyncio.to_thread(self.get_video_info, video) for video in video_files
+        ))
+        target = infos[0]
+        if not target or target['codec'] not in VIDEO_ENCODERS:
+            return video_files
+        
+        matched = []
+        for video, info in zip(video_files, infos):
+            # Parts that can't be probed are left for the concat to reject
+            if not info or all(info[key] == target[key] for key in MATCH_KEYS):
+                matched.append(video)
+                continue
+            
+            output_path = f"{os.path.splitext(video)[0]}.matched.mp4"
+            await self.transcode(video, output_path, target)
+            os.remove(video)
+            matched.append(output_path)
+        return matched
+    
+    async def transcode(self, input_path, output_path, target, workers=None):
+        """Re-encode input_path to the stream properties of target.
+        
+        Long inputs are split at keyframes into up to workers time segments
+        that are encoded in parallel (audio is encoded once, alongside them)
+        and then joined with the concat demuxer without re-encoding.
+        """
+        import ffmpeg
+        workers = workers or Config.TRANSCODE_WORKERS
+        info = await asyncio.to_thread(self.get_video_info, input_path)
+        
+        segments = int(min(workers, info['duration'] // Config.TRANSCODE_SEGMENT_MIN_DURATION))
+        if segments < 2:
+            # One ffmpeg process with all cores
+            command = self.build_transcode(input_path, output_path, info, target)
+            await run_ffmpeg(command)
+            return output_path
+        
+        points = await asyncio.to_thread(
+            self.get_split_points, input_path, info['duration'], segments
+        )
+        threads = max(1, (os.cpu_count() or 1) // len(points))
+        work_dir = tempfile.mkdtemp(dir=self.download_dir)
+        try:
+            commands = []
+            segment_paths = []
+            for index, start in enumerate(points):
+                end = points[index + 1] if index + 1 < len(points) else None
+                segment_path = os.path.join(work_dir, f"segment_{index:03d}.mp4")
+                segment_paths.append(segment_path)
+                commands.append(self.build_transcode(
+                    input_path, segment_path, info, target,
+                    start=start, end=end, audio=False, threads=threads
+                ))
+            
+            audio_path = None
+            if target['audio_codec']:
+                audio_path = os.path.join(work_dir, "audio.mka")
+                commands.append(self.build_audio_transcode(input_path, audio_path, info, target))
+            
+            # Each command is its own ffmpeg process, so they run in parallel
+            # straight from the event loop
+            tasks = [asyncio.create_task(run_ffmpeg(command)) for command in commands]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Stop the other encodes before their work directory is removed
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            
+            list_file = os.path.join(work_dir, "segments.txt")
+            with open(list_file, "w") as f:
+                for segment_path in segment_paths:
+                    f.write(f"file '{os.path.abspath(segment_path)}'\n")
+            
+            streams = [ffmpeg.input(list_file, format='concat', safe=0).video]
+            if audio_path:
+                streams.append(ffmpeg.input(audio_path).audio)
+            stream = ffmpeg.output(*streams, output_path, c='copy')
+            await run_ffmpeg(ffmpeg.compile(stream, overwrite_output=True))
+            return output_path
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    @staticmethod
+    def build_transcode(input_path, output_path, info, target, start=None, end=None,
+                        audio=True, threads=0):
+        """ffmpeg command line re-encoding (a time range of) input_path like target"""
+        import ffmpeg
+        input_args = {}
+        if start:
+            input_args['ss'] = start
+        if end is not None:
+            input_args['t'] = end - (start or 0)
+        source = ffmpeg.input(input_path, **input_args)
+        
+        video = source.video
+        if (info['width'], info['height']) != (target['width'], target['height']):
+            video = video.filter('scale', target['width'], target['height']).filter('setsar', 1)
+        
+        streams = [video]
+        output_args = {
+            'vcodec': VIDEO_ENCODERS[target['codec']],
+            'pix_fmt': target['pix_fmt'],
+            'preset': Config.TRANSCODE_PRESET,
+            'crf': Config.TRANSCODE_CRF,
+            'threads': threads
+        }
+        if audio and target['audio_codec']:
+            streams.append(VideoMerger.get_audio_source(source, input_path, info))
+            output_args.update(VideoMerger.get_audio_args(target))
+        
+        output_args = {k: v for k, v in output_args.items() if v is not None}
+        stream = ffmpeg.output(*streams, output_path, **output_args)
+        return ffmpeg.compile(stream, overwrite_output=True)
+    
+    @staticmethod
+    def build_audio_transcode(input_path, output_path, info, target):
+        """ffmpeg command line re-encoding only the audio of input_path like target"""
+        import ffmpeg
+        audio = VideoMerger.get_audio_source(ffmpeg.input(input_path), input_path, info)
+        stream = ffmpeg.output(audio, output_path, **VideoMerger.get_audio_args(target))
+        return ffmpeg.compile(stream, overwrite_output=True)
+    
+    @staticmethod
+    def get_audio_source(source, input_path, info):
+        """The input's audio, or silence of the same length if it has none"""
+        import ffmpeg
+        if info['audio_codec']:
+            return source.audio
+        return ffmpeg.input('anullsrc', format='lavfi', t=info['duration']).audio
+    
+    @staticmethod
+    def get_audio_args(target):
+        return {
+            'acodec': AUDIO_ENCODERS.get(target['audio_codec'], 'aac'),
+            'ar': target['sample_rate'],
+            'ac': target['channels']
+        }
+    
+    @staticmethod
+    def get_split_points(file_path, duration, segments):
+        """Start times of up to segments time ranges, each beginning on a keyframe"""
+        import ffmpeg
+        probe = ffmpeg.probe(
+            file_path,
+            select_streams='v:0',
+            show_entries='packet=pts_time,flags'
+        )
+        # Input seeking (-ss) is relative to the container start time
+        start_time = float(probe['format'].get('start_time', 0))
+        keyframes = sorted(
+            float(p['pts_time']) - start_time
+            for p in probe.get('packets', [])
+            if 'K' in p.get('flags', '') and p.get('pts_time', 'N/A') != 'N/A'
+        )
+        
+        points = [0.0]
+        for index in range(1, segments):
+            target = duration * index / segments
+            candidates = [k for k in keyframes if points[-1] < k < duration]
+            if not candidates:
+                break
+            points.append(min(candidates, key=lambda k: abs(k - target)))
+        return sorted(set(points))
+    
     @staticmethod
     def get_video_info(file_path):
+        import ffmpeg
         try:
             probe = ffmpeg.probe(file_path)
             video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
+            audio_info = next((s for s in probe['streams'] if s['codec_type'] == 'audio'), {})
             
             return {
                 'duration': float(probe['format']['duration']),
                 'width': int(video_info['width']),
                 'height': int(video_info['height']),
-                'codec': video_info['codec_name']
+                'codec': video_info['codec_name'],
+                'pix_fmt': video_info.get('pix_fmt'),
+                'audio_codec': audio_info.get('codec_name'),
+                'sample_rate': int(audio_info.get('sample_rate', 0)),
+                'channels': audio_info.get('channels', 0)
             }
         except Exception as e:
             print(f"Error getting video info: {str(e)}")
-            return None 
\ No newline at end of file
+            return None